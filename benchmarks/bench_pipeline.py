@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+v1 请求处理流程(request_validate、response_filter、scopes 等)的整体开销
+
+不依赖外部服务: sqlite 内存数据库、mockredis、微信接口用固定返回值代替
+
+    python benchmarks/bench_pipeline.py -n 2000 -o benchmarks/results/HEAD.json
+    python benchmarks/bench_pipeline.py --compare benchmarks/results/old.json
+
+结果为 json，包含每个场景的 rps 和 p50/p99 延迟(毫秒)，
+--compare 和之前的结果对比
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from contextlib import contextmanager
+from timeit import default_timer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+
+from src.v1 import api, schemas  # noqa
+from src.v1.api import Resource  # noqa
+
+
+class BenchList(Resource):
+    """只用于压测的列表接口，?n= 控制返回条数"""
+
+    rows = [dict(account_id=i, nickname='player%d' % i, score=1500 + i,
+                 rank=i + 1, avatar=None) for i in range(1000)]
+
+    def get(self):
+        from flask import g
+        return self.rows[:g.args.get('n', 10)], 200, None
+
+
+schemas.validators[('bench_list', 'GET')] = {
+    'args': {'properties': {'n': {'type': 'integer'}}}}
+schemas.filters[('bench_list', 'GET')] = {200: {'headers': None, 'schema': {
+    'type': 'array',
+    'items': {
+        'required': ['account_id'],
+        'properties': {
+            'account_id': {'type': 'integer'},
+            'nickname': {'type': 'string'},
+            'score': {'type': 'integer'},
+            'rank': {'type': 'integer'},
+            'avatar': {'type': 'string', 'default': ''},
+        },
+    },
+}}}
+schemas.scopes[('bench_list', 'GET')] = ['open']
+api.add_resource(BenchList, '/bench/list', endpoint='bench_list')
+
+
+def stub_weixin():
+    from src.services import weixin
+
+    weixin.WXAPPAPI.jscode2session = lambda self, js_code: {
+        'openid': 'bench-openid', 'session_key': 'bench-session-key'}
+    weixin.WXBizDataCrypt.decrypt = lambda self, encrypted_data, iv: {
+        'openId': 'bench-openid', 'nickName': 'bench',
+        'watermark': {'appid': 'bench'}}
+
+
+def sqlite_savepoints(engine):
+    # pysqlite 不发出 BEGIN，savepoint 不可用，按 sqlalchemy 文档的做法修正
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.execute('BEGIN')
+
+
+def create_bench_app():
+    from zaih_core.database import db
+    from src.app import create_app
+    from src.models import Account, OAuth2Token
+
+    app = create_app(test=True)
+    with app.app_context():
+        sqlite_savepoints(db.engine)
+        db.create_all()
+        account = Account.create(nickname='bench')
+        token = OAuth2Token.get_or_create('XiaoChengXu', account_id=account.id)
+        access_token = token.access_token
+    return app, access_token
+
+
+def scenarios(access_token):
+    from src.settings import Config
+
+    bearer = {'Authorization': 'Bearer %s' % access_token}
+    basic = {'Authorization': 'Basic %s' % Config.DEFAULT_BASIC_TOKEN}
+    code = json.dumps({'code': 'bench', 'iv': 'iv', 'encrypted_data': 'x'})
+    return [
+        ('hello', 'GET', '/v1/hello', bearer, None),
+        ('code_token', 'POST', '/v1/code/token',
+         dict(basic, **{'Content-Type': 'application/json'}), code),
+        ('list_10', 'GET', '/v1/bench/list?n=10', bearer, None),
+        ('list_100', 'GET', '/v1/bench/list?n=100', bearer, None),
+        ('list_1000', 'GET', '/v1/bench/list?n=1000', bearer, None),
+        ('list_1000_gzip', 'GET', '/v1/bench/list?n=1000',
+         dict(bearer, **{'Accept-Encoding': 'gzip'}), None),
+    ]
+
+
+@contextmanager
+def quiet():
+    # 流程中还有调试用的 print，压测时不输出
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+def run(client, method, path, headers, data, number, warmup):
+    for _ in range(warmup):
+        client.open(path, method=method, headers=headers, data=data)
+    latencies = []
+    start = default_timer()
+    for _ in range(number):
+        t = default_timer()
+        resp = client.open(path, method=method, headers=headers, data=data)
+        latencies.append(default_timer() - t)
+        if resp.status_code != 200:
+            raise RuntimeError('%s %s: %s %s' % (
+                method, path, resp.status_code, resp.data[:200]))
+    total = default_timer() - start
+    latencies.sort()
+    return {
+        'requests': number,
+        'rps': round(number / total, 1),
+        'mean_ms': round(total / number * 1000, 3),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    print('%-16s %10s %10s %8s %10s %10s %8s' % (
+        'scenario', 'old rps', 'new rps', 'diff', 'old p99', 'new p99', 'diff'))
+    for name, result in sorted(new['scenarios'].items()):
+        before = old['scenarios'].get(name)
+        if not before:
+            continue
+        print('%-16s %10.1f %10.1f %+7.1f%% %10.3f %10.3f %+7.1f%%' % (
+            name, before['rps'], result['rps'],
+            (result['rps'] / before['rps'] - 1) * 100,
+            before['p99_ms'], result['p99_ms'],
+            (result['p99_ms'] / before['p99_ms'] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=1000)
+    parser.add_argument('-w', '--warmup', type=int, default=50)
+    parser.add_argument('-s', '--scenario', action='append',
+                        help='only run these scenarios')
+    parser.add_argument('-o', '--output', help='write results to this file')
+    parser.add_argument('--compare', help='previous results file')
+    args = parser.parse_args()
+
+    stub_weixin()
+    app, access_token = create_bench_app()
+    client = app.test_client()
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'timestamp': int(time.time()),
+        'scenarios': {},
+    }
+    for name, method, path, headers, data in scenarios(access_token):
+        if args.scenario and name not in args.scenario:
+            continue
+        with quiet():
+            result = run(client, method, path, headers, data,
+                         args.number, args.warmup)
+        results['scenarios'][name] = result
+        print('%-16s %8.1f rps  p50 %7.3fms  p99 %7.3fms' % (
+            name, result['rps'], result['p50_ms'], result['p99_ms']))
+
+    if args.output:
+        dirname = os.path.dirname(args.output)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
-# from gevent.monkey import patch_all; patch_all()
+import sys
+
+# gevent 模式必须在导入其他模块之前 patch socket / psycopg2
+if sys.argv[1:2] == ['gevent_server']:
+    from gevent.monkey import patch_all; patch_all()
+    from psycogreen.gevent import patch_psycopg; patch_psycopg()
 
 import os
 import yaml
@@ -90,6 +95,78 @@ def swagger_py_codegen(swagger, dist, package):
     print 'code generate success!'
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=1000, help='rows deleted per transaction')
+@manager.option('-s', '--start-id', dest='start_id', type=int, default=0,
+                help='resume after this oauth2_token id')
+def purge_tokens(batch_size, start_id):
+    """Delete oauth2 tokens whose refresh token has expired."""
+    from src.models import OAuth2Token
+    total = 0
+    for count, last_id in OAuth2Token.purge_expired(batch_size, start_id):
+        total += count
+        print 'purged %s tokens, last id %s' % (total, last_id)
+    print 'purge success!'
+
+
+@manager.option('-p', '--port', dest='port', type=int, default=8140)
+@manager.option('-c', '--concurrency', dest='concurrency', type=int,
+                default=500, help='max concurrent requests per process')
+@manager.option('--db-pool-size', dest='db_pool_size', type=int, default=20)
+@manager.option('--upstream-pool-size', dest='upstream_pool_size', type=int,
+                default=50, help='keep-alive connections per upstream host')
+def gevent_server(port, concurrency, db_pool_size, upstream_pool_size):
+    """Run the app on a gevent WSGI server."""
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+    from src.services.utils import Request
+
+    # 等待微信接口时不占用数据库连接，数据库连接池不需要和并发数一样大
+    app.config['SQLALCHEMY_POOL_SIZE'] = db_pool_size
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = db_pool_size
+    Request.configure(pool_maxsize=upstream_pool_size)
+
+    server = WSGIServer(('0.0.0.0', port), app, spawn=Pool(concurrency))
+    print 'gevent server listening on 0.0.0.0:%s' % port
+    server.serve_forever()
+
+
+@manager.option('-f', '--file', dest='filename', required=True,
+                help='scene per line')
+@manager.option('-p', '--page', dest='page', default=None)
+@manager.option('-c', '--concurrency', dest='concurrency', type=int,
+                default=4)
+def wxacode_batch(filename, page, concurrency):
+    """Fetch mini-program codes for scenes into the wxacode cache."""
+    from src.services.wxacode import WXACodeService
+    with open(filename, 'r') as f:
+        scenes = [line.strip().decode('utf-8') for line in f if line.strip()]
+    options = {'page': page} if page else {}
+    results, errors = WXACodeService().get_many(
+        'unlimit', scenes, concurrency=concurrency, **options)
+    for scene, error in errors.items():
+        print 'failed %s: %s' % (scene, error)
+    print 'wxacode success: %s, failed: %s' % (len(results), len(errors))
+
+
+@manager.option('-l', '--local', dest='local', action='store_true',
+                default=False, help='only caches of this process')
+def cache_stats(local):
+    """Dump cache and HTTP client stats published by app processes."""
+    import json
+    from zaih_core.caching import cache_registry
+    from src.app import CACHE_STATS_KEY
+    from src.extensions import redis
+    from src.settings import Config
+    if local:
+        data = {'caches': cache_registry.snapshot(),
+                'sources': cache_registry.sources()}
+    else:
+        data = cache_registry.published(
+            redis, CACHE_STATS_KEY, ttl=Config.CACHE_STATS_INTERVAL * 3)
+    print json.dumps(data, indent=2, sort_keys=True)
+
+
 manager.add_command('server', Server(host='0.0.0.0', port='8140',
                                      use_reloader=True, processes=4))
 manager.add_command('db', MigrateCommand)
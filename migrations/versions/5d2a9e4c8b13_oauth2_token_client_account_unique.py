@@ -0,0 +1,28 @@
+"""oauth2_token unique (client_id, account_id)
+
+Revision ID: 5d2a9e4c8b13
+Revises: 1c8e5a2b7f90
+Create Date: 2026-10-18 16:20:05.418301
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2a9e4c8b13'
+down_revision = '1c8e5a2b7f90'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # 只保留每个 (client_id, account_id) 最新的一条记录
+    op.execute('DELETE FROM oauth2_token a USING oauth2_token b '
+               'WHERE a.client_id = b.client_id '
+               'AND a.account_id = b.account_id AND a.id < b.id')
+    with op.batch_alter_table('oauth2_token', schema=None) as batch_op:
+        batch_op.create_index('ix_oauth2_token_client_id_account_id', ['client_id', 'account_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('oauth2_token', schema=None) as batch_op:
+        batch_op.drop_index('ix_oauth2_token_client_id_account_id')
@@ -5,15 +5,39 @@ try:
     import cPickle as pickle
 except ImportError:
     import pickle
+import os
+import sys
+import json
 import time
+import zlib
+import types
+import socket
+import hashlib
+import logging
+import threading
+from datetime import date
+from collections import OrderedDict
 from functools import wraps
 
-from flask import g
+import six
+from flask import g, current_app
 from pymemcache.client.hash import HashClient
+from pymemcache.exceptions import MemcacheError
+from redis.exceptions import RedisError
 
 from mock_memcache import MockMemcache
 
 
+logger = logging.getLogger(__name__)
+
+SHARED_ERRORS = (MemcacheError, RedisError, socket.error)
+
+# 可以直接放进缓存 key 的参数类型，按 type 精确匹配:
+# 1、True、1.0 相等且 hash 相同，bool/float 等放进 key 会互相冲突，
+# py2 的 str 和 unicode 同理，这些类型用 pickle 的摘要区分
+KEY_TYPES = frozenset([int, six.text_type, type(None)])
+
+
 def format_memcached_servers(memcached_urls):
     servers = []
     urls = memcached_urls.split(',')
@@ -26,24 +50,726 @@ def format_memcached_servers(memcached_urls):
     return servers
 
 
-def cache_for(duration, with_uid=False):
+def _json_default(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, '__cache_key__'):
+        return value.__cache_key__()
+    raise TypeError(repr(value))
+
+
+def stable_dumps(value):
+    '''
+    把参数序列化成稳定的 bytes，用于计算摘要
+
+    优先用排序后的 json，和 pickle 协议、python 版本、dict 顺序无关；
+    json 不支持的对象可以实现 __cache_key__，否则退回到 pickle
+    '''
+    try:
+        data = json.dumps(value, sort_keys=True, separators=(',', ':'),
+                          default=_json_default)
+    except (TypeError, ValueError):
+        return pickle.dumps(value, 2)
+    return data.encode('utf-8') if isinstance(data, six.text_type) else data
+
+
+def _digest(value):
+    return ('#', hashlib.sha1(
+        pickle.dumps(value, pickle.HIGHEST_PROTOCOL)).hexdigest())
+
+
+def make_key(args, kwargs=None):
+    '''
+    由函数参数生成进程内缓存的 key
+
+    参数都是 int、文本或 None 时直接用参数 tuple，不需要序列化；
+    其他参数用 ('#', pickle 的摘要) 代替。这个 key 只在进程内使用，
+    共享缓存的 key 由 stable_dumps 生成，只在进程内未命中时计算
+    '''
+    key = tuple(args)
+    for arg in key:
+        if type(arg) not in KEY_TYPES:
+            key = tuple(a if type(a) in KEY_TYPES else _digest(a)
+                        for a in key)
+            break
+    if kwargs:
+        key += tuple((k, v if type(v) in KEY_TYPES else _digest(v))
+                     for k, v in sorted(six.iteritems(kwargs)))
+    return key
+
+
+def code_version(func):
+    '''
+    函数代码的摘要，函数(包括内部定义的函数)改动后才会变化
+
+    用作缓存 key 的版本号，发布后只有改动过的函数的缓存失效
+    '''
+    def update(h, code):
+        h.update(code.co_code)
+        h.update(' '.join(code.co_names).encode('utf-8'))
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                update(h, const)
+            else:
+                h.update(repr(const).encode('utf-8'))
+
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return '0'
+    h = hashlib.sha1()
+    update(h, code)
+    return h.hexdigest()[:8]
+
+
+class MemoryStore(object):
+    """
+    进程内缓存存储，按 LRU 淘汰
+
+    条目数超过 max_entries 或者占用超过 max_bytes 时淘汰最久未使用的数据，
+    每隔 sweep_interval 秒清理一次已过期的数据
+
+    :Parameters
+        - max_entries 最大条目数
+        - max_bytes 最大占用字节数(按 pickle 后的长度估算)，0 为不限制
+        - sweep_interval 清理过期数据的间隔(秒)
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024,
+                 sweep_interval=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._data = OrderedDict()  # key -> (value, expire, size)
+        self._lock = threading.RLock()
+        self._next_sweep = None
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @staticmethod
+    def sizeof(key, value):
+        # key 可能是参数 tuple，和 value 一起按 pickle 后的长度估算
+        try:
+            return len(pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def get(self, key, now=None):
+        now = now or time.time()
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expire, size = item
+            if expire <= now:
+                self.bytes -= size
+                self.expirations += 1
+                return None
+            # 重新插入到队尾，标记为最近使用
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, expire, now=None):
+        now = now or time.time()
+        size = self.sizeof(key, value)
+        with self._lock:
+            self._remove(key)
+            if self._next_sweep is None:
+                self._next_sweep = now + self.sweep_interval
+            elif now >= self._next_sweep:
+                self.sweep(now)
+            if self.max_bytes and size > self.max_bytes:
+                return False
+            self._data[key] = (value, expire, size)
+            self.bytes += size
+            while self._data and (
+                    len(self._data) > self.max_entries or
+                    (self.max_bytes and self.bytes > self.max_bytes)):
+                _, (_, _, _size) = self._data.popitem(last=False)
+                self.bytes -= _size
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is None:
+            return False
+        self.bytes -= item[2]
+        return True
+
+    def sweep(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            expired = [k for k, (_, expire, _) in six.iteritems(self._data)
+                       if expire <= now]
+            for key in expired:
+                self._remove(key)
+            self.expirations += len(expired)
+            self._next_sweep = now + self.sweep_interval
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._data),
+            'bytes': self.bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class CacheStats(object):
+    """
+    单个缓存的统计: 命中、未命中、返回旧数据的次数，计算耗时的分布，
+    以及 stores 中的条目数、占用字节数和淘汰数
+
+    negative_hits 是命中"不存在/无效"结果的次数(同时计入 hits)，
+    errors 是缓存后端出错、降级为直接计算的次数
+
+    同一个名字的多个缓存(例如多个进程内缓存共用一个 namespace)合并统计
+    """
+
+    # 计算耗时分布的上界(秒)
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+    counters = ('hits', 'misses', 'stale', 'shared_hits', 'shared_misses',
+                'negative_hits', 'errors')
+
+    def __init__(self, name):
+        self.name = name
+        self.stores = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counts = dict.fromkeys(self.counters, 0)
+            self.latency_counts = [0] * (len(self.buckets) + 1)
+            self.latency_sum = 0.0
+
+    def incr(self, counter, n=1):
+        with self._lock:
+            self.counts[counter] += n
+
+    def observe(self, seconds):
+        i = 0
+        while i < len(self.buckets) and seconds > self.buckets[i]:
+            i += 1
+        with self._lock:
+            self.latency_counts[i] += 1
+            self.latency_sum += seconds
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.counts)
+            latency_counts = list(self.latency_counts)
+            latency_sum = self.latency_sum
+        lookups = data['hits'] + data['misses']
+        data['hit_ratio'] = (round(float(data['hits']) / lookups, 4)
+                             if lookups else None)
+        # 和 prometheus 一样，每个桶是耗时小于等于上界的累计次数
+        total = 0
+        buckets = []
+        for le, count in zip(self.buckets + ('+Inf',), latency_counts):
+            total += count
+            buckets.append(['%s' % le, total])
+        data['latency'] = {'count': total, 'sum': round(latency_sum, 6),
+                           'buckets': buckets}
+        for field in ('entries', 'bytes', 'evictions'):
+            data[field] = None
+        for store in self.stores:
+            stats = store.stats() if hasattr(store, 'stats') else {}
+            for field in ('entries', 'bytes', 'evictions'):
+                if field in stats:
+                    data[field] = (data[field] or 0) + stats[field]
+        return data
+
+
+class CacheRegistry(object):
+    """
+    所有缓存的统计，cache_for 和 CacheMeta 自动注册
+
+    - snapshot() 返回 {name: stats}，用于管理接口、命令行
+    - collect() 返回 (metric, labels, value) 列表，供监控系统定时拉取
+    - publish()/published() 把各个进程的统计写到 redis 并汇总读取
+    - register_source() 注册缓存之外的统计(比如第三方接口的连接池)，
+      由 sources() 输出，和缓存统计一起 publish
+    """
+
+    def __init__(self):
+        self._stats = OrderedDict()
+        self._sources = OrderedDict()
+        self._lock = threading.Lock()
+        self._published_at = 0
+
+    def __iter__(self):
+        return iter(list(self._stats.values()))
+
+    def register(self, name, store=None):
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = CacheStats(name)
+            if store is not None and store not in stats.stores:
+                stats.stores.append(store)
+        return stats
+
+    def get(self, name):
+        return self._stats.get(name)
+
+    def register_source(self, name, func):
+        '''func 不接受参数，返回可以 json 序列化的统计'''
+        with self._lock:
+            self._sources[name] = func
+        return func
+
+    def sources(self):
+        results = OrderedDict()
+        for name, func in list(self._sources.items()):
+            try:
+                results[name] = func()
+            except Exception as e:
+                logger.warning('stats source %s failed: %s', name, e)
+        return results
+
+    def snapshot(self):
+        return OrderedDict((stats.name, stats.snapshot()) for stats in self)
+
+    def collect(self):
+        metrics = []
+        for name, data in six.iteritems(self.snapshot()):
+            labels = {'cache': name}
+            for counter in CacheStats.counters:
+                metrics.append(('cache_%s_total' % counter, labels,
+                                data[counter]))
+            for field in ('entries', 'bytes', 'evictions'):
+                if data[field] is not None:
+                    metrics.append(('cache_%s' % field, labels, data[field]))
+            latency = data['latency']
+            for le, count in latency['buckets']:
+                metrics.append(('cache_compute_seconds_bucket',
+                                dict(labels, le=le), count))
+            metrics.append(('cache_compute_seconds_count', labels,
+                            latency['count']))
+            metrics.append(('cache_compute_seconds_sum', labels,
+                            latency['sum']))
+        return metrics
+
+    def reset(self):
+        for stats in self:
+            stats.reset()
+
+    def publish(self, client, key, ttl=300, interval=0):
+        '''
+        把当前进程的统计写到 redis hash 中，field 为 "主机名:pid"
+
+        距离上次写入不到 interval 秒时跳过，可以在每个请求结束时调用
+        '''
+        now = time.time()
+        if now - self._published_at < interval:
+            return False
+        self._published_at = now
+        data = {'timestamp': int(now), 'caches': self.snapshot(),
+                'sources': self.sources()}
+        field = '%s:%s' % (socket.gethostname(), os.getpid())
+        try:
+            with client.pipeline(transaction=False) as p:
+                p.hset(key, field, json.dumps(data))
+                p.expire(key, ttl)
+                p.execute()
+        except SHARED_ERRORS as e:
+            logger.warning('cache stats publish failed: %s', e)
+            return False
+        return True
+
+    def published(self, client, key, ttl=300):
+        '''
+        读取 publish 写入的统计，ttl 秒内没有更新的进程(已经退出或者
+        重启过)从 hash 中删除
+        '''
+        now = time.time()
+        result = {}
+        expired = []
+        for field, value in six.iteritems(client.hgetall(key)):
+            data = json.loads(value)
+            if now - data['timestamp'] > ttl:
+                expired.append(field)
+                continue
+            if isinstance(field, bytes):
+                field = field.decode('utf-8')
+            result[field] = data
+        if expired:
+            client.hdel(key, *expired)
+        return result
+
+
+cache_registry = CacheRegistry()
+
+
+class SharedStore(object):
+    """
+    进程间共享的缓存存储，作为 cache_for 的第二级缓存
+
+    值用 pickle 序列化，超过 compress_min_size 字节时再用 zlib 压缩，
+    后端不可用时当作未命中处理，不影响调用
+
+    :Parameters
+        - client 缓存客户端，默认在使用时从 current_app.extensions 中获取
+        - namespace key 前缀，不同服务共用缓存时用来区分
+        - compress_min_size 压缩的最小长度
+    """
+
+    extension = None
+
+    def __init__(self, client=None, namespace='zc', compress_min_size=1024):
+        self._client = client
+        self.namespace = namespace
+        self.compress_min_size = compress_min_size
+
+    @property
+    def client(self):
+        if self._client is not None:
+            return self._client
+        return current_app.extensions[self.extension]
+
+    def make_key(self, namespace, key):
+        if not isinstance(key, bytes):
+            key = stable_dumps(key)
+        return '%s:%s:%s' % (self.namespace, namespace,
+                             hashlib.sha1(key).hexdigest())
+
+    def dumps(self, value):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) >= self.compress_min_size:
+            compressed = zlib.compress(data)
+            if len(compressed) < len(data):
+                return b'z' + compressed
+        return b'p' + data
+
+    def loads(self, data):
+        if data[:1] == b'z':
+            return pickle.loads(zlib.decompress(data[1:]))
+        return pickle.loads(data[1:])
+
+    def get(self, key):
+        try:
+            data = self.client.get(key)
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache get failed: %s', e)
+            return None
+        if data is None:
+            return None
+        try:
+            return self.loads(data)
+        except Exception as e:
+            logger.warning('shared cache loads failed: %s', e)
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self._set(self.client, key, self.dumps(value), ttl)
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache set failed: %s', e)
+
+    def get_many(self, keys):
+        '''一次请求读取多个 key，返回命中的 {key: value}'''
+        if not keys:
+            return {}
+        try:
+            values = self._get_many(self.client, keys)
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache get_many failed: %s', e)
+            return {}
+        result = {}
+        for key, data in zip(keys, values):
+            if data is None:
+                continue
+            try:
+                result[key] = self.loads(data)
+            except Exception as e:
+                logger.warning('shared cache loads failed: %s', e)
+        return result
+
+    def set_many(self, values, ttl):
+        if not values:
+            return
+        data = dict((key, self.dumps(value))
+                    for key, value in six.iteritems(values))
+        try:
+            self._set_many(self.client, data, ttl)
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache set_many failed: %s', e)
+
+    def delete(self, key):
+        try:
+            self.client.delete(key)
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache delete failed: %s', e)
+
+    def acquire(self, key, ttl):
+        '''
+        获取 ttl 秒后自动释放的锁，后端不可用时返回 True，
+        调用方直接计算，不会因为缓存故障阻塞
+        '''
+        try:
+            return bool(self._add(self.client, key, b'1', ttl))
+        except SHARED_ERRORS as e:
+            logger.warning('shared cache lock failed: %s', e)
+            return True
+
+    def release(self, key):
+        self.delete(key)
+
+    def _set(self, client, key, data, ttl):
+        raise NotImplementedError
+
+    def _add(self, client, key, data, ttl):
+        raise NotImplementedError
+
+    def _get_many(self, client, keys):
+        '''按 keys 的顺序返回值，未命中的为 None'''
+        raise NotImplementedError
+
+    def _set_many(self, client, data, ttl):
+        raise NotImplementedError
+
+
+class MemcacheStore(SharedStore):
+
+    extension = 'memc'
+
+    def _set(self, client, key, data, ttl):
+        client.set(key, data, expire=ttl)
+
+    def _add(self, client, key, data, ttl):
+        return client.add(key, data, expire=ttl, noreply=False)
+
+    def _get_many(self, client, keys):
+        values = client.get_many(keys)
+        return [values.get(key) for key in keys]
+
+    def _set_many(self, client, data, ttl):
+        client.set_many(data, expire=ttl)
+
+
+class RedisStore(SharedStore):
+
+    extension = 'redis'
+
+    def _set(self, client, key, data, ttl):
+        client.set(key, data, ex=ttl)
+
+    def _add(self, client, key, data, ttl):
+        return client.set(key, data, ex=ttl, nx=True)
+
+    def _get_many(self, client, keys):
+        return client.mget(keys)
+
+    def _set_many(self, client, data, ttl):
+        with client.pipeline(transaction=False) as p:
+            for key, value in six.iteritems(data):
+                p.set(key, value, ex=ttl)
+            p.execute()
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.failed = False
+
+
+class InFlight(object):
+    """
+    同一个 key 同时只有一个调用在执行，其他调用等待并使用它的结果
+
+    执行出错或等待超时时，等待的调用自己执行一次
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def running(self, key):
+        return key in self._calls
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            if call.event.wait(timeout) and not call.failed:
+                return call.value
+            return func()
+        try:
+            call.value = func()
+        except:
+            call.failed = True
+            raise
+        finally:
+            call.event.set()
+            with self._lock:
+                self._calls.pop(key, None)
+        return call.value
+
+
+def cache_for(duration, with_uid=False, store=None, shared=None,
+              shared_duration=None, namespace=None, version=None, stale=0,
+              lock_timeout=5):
+    """
+    缓存函数返回值 duration 秒
+
+    依次查找进程内的 store、进程间共享的 shared，都没有时才调用函数，
+    新启动的进程可以直接用 shared 中的数据
+
+    同一个 key 在进程内只有一个调用在计算，其他调用等待结果；
+    使用 shared 时通过 shared 中的锁保证多个进程也只计算一次。
+    stale 大于 0 时，过期 stale 秒内的数据仍然可以返回，
+    由其中一个调用重新计算，其他调用直接使用旧数据
+
+    统计注册在 cache_registry 中，名字为 namespace(默认为模块名和函数名)，
+    也可以通过被装饰函数的 stats 属性查看
+
+    key 以 "函数名:版本号" 开头，版本号默认为函数代码的摘要，
+    发布后只有改动过的函数缓存失效；返回值格式变化而代码没变时可以手动修改 version
+
+    :Parameters
+        - with_uid 缓存 key 是否区分当前用户
+        - store 缓存存储，默认为一个新的 MemoryStore，
+          可以通过被装饰函数的 cache 属性查看大小和淘汰计数
+        - shared 共享缓存 MemcacheStore/RedisStore，默认不使用
+        - shared_duration 共享缓存的过期时间，默认和 duration 相同
+        - namespace key 前缀，默认为函数的模块名和函数名
+        - version key 的版本号，默认为 code_version(func)
+        - stale 过期后还可以使用旧数据的时间(秒)
+        - lock_timeout 等待其他调用计算结果的最长时间(秒)
+    """
     def deco(func):
+        cache = store if store is not None else MemoryStore()
+        inflight = InFlight()
+        shared_ttl = shared_duration or duration
+        name = namespace or '%s.%s' % (
+            func.__module__, getattr(func, '__qualname__', func.__name__))
+        prefix = '%s:%s' % (name, version or code_version(func))
+        stats = cache_registry.register(name, cache)
+
+        def compute(args, kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.observe(time.time() - start)
+
+        def shared_key_for(args, kwargs, extra=()):
+            return shared.make_key(prefix, [args, kwargs] + list(extra))
+
+        def call(key, args, kwargs, extra, stale_value=None):
+            # 缓存中的值为 (value, fresh_until)，超过 fresh_until 后为旧数据
+            now = int(time.time())
+            if shared is None:
+                return store_value(key, compute(args, kwargs), now)
+
+            shared_key = shared_key_for(args, kwargs, extra)
+            entry = shared.get(shared_key)
+            if entry is not None and entry[1] > now:
+                stats.incr('shared_hits')
+                return store_local(key, entry, now)
+            stats.incr('shared_misses')
+            lock_key = shared_key + ':lock'
+            locked = shared.acquire(lock_key, lock_timeout)
+            if not locked:
+                # 其他进程正在计算，stale 窗口内有旧数据时直接使用，
+                # 否则等待它的结果
+                if stale and stale_value is None and entry is not None and \
+                        entry[1] + stale > now:
+                    stale_value = entry[0]
+                if stale and stale_value is not None:
+                    stats.incr('stale')
+                    return stale_value
+                entry = wait_shared(shared_key)
+                if entry is not None:
+                    return store_local(key, entry, now)
+            try:
+                value = store_value(key, compute(args, kwargs), now)
+                if value is not None:
+                    shared.set(shared_key, (value, now + shared_ttl),
+                               shared_ttl + stale)
+                return value
+            finally:
+                if locked:
+                    shared.release(lock_key)
+
+        def wait_shared(shared_key):
+            deadline = time.time() + lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.05)
+                entry = shared.get(shared_key)
+                if entry is not None and entry[1] > time.time():
+                    return entry
+            return None
+
+        def store_value(key, value, now):
+            if value is not None:
+                cache.set(key, (value, now + duration),
+                          now + duration + stale)
+            return value
+
+        def store_local(key, entry, now):
+            value, fresh_until = entry
+            fresh_until = min(fresh_until, now + duration)
+            cache.set(key, (value, fresh_until), fresh_until + stale)
+            return value
+
         @wraps(func)
         def fn(*args, **kwargs):
-            all_args = []
+            extra = ()
             if with_uid:
                 from tutor.apis.helpers import current_user
                 if current_user.is_authenticated():
-                    all_args.append(current_user.id)
-            all_args.append(args)
-            key = pickle.dumps((all_args, kwargs))
-            value, expire = func.func_dict.get(key, (None, None))
+                    extra = (('uid', current_user.id),)
+            key = (prefix,) + make_key(args, kwargs) + extra
             now = int(time.time())
-            if value is not None and expire > now:
-                return value
-            value = func(*args, **kwargs)
-            func.func_dict[key] = (value, int(time.time()) + duration)
-            return value
+            entry = cache.get(key, now)
+            value = None
+            if entry is not None:
+                value, fresh_until = entry
+                if fresh_until > now:
+                    stats.incr('hits')
+                    return value
+                if inflight.running(key):
+                    stats.incr('stale')
+                    return value
+            stats.incr('misses')
+            return inflight.do(key,
+                               lambda: call(key, args, kwargs, extra, value),
+                               lock_timeout)
+        fn.cache = cache
+        fn.shared = shared
+        fn.prefix = prefix
+        fn.stats = stats
+        if shared is not None:
+            fn.shared_key = lambda *args, **kwargs: shared_key_for(args,
+                                                                 kwargs)
         return fn
     return deco
 
@@ -53,6 +779,25 @@ class CacheMeta(object):
     meta_name = None
     meta_ids = None
 
+    @classmethod
+    def cache_stats(cls):
+        '''
+        每个子类在 cache_registry 中的统计，名字为 meta:模块名.类名
+
+        hits/misses 为 _meta_values 是否已经在本次请求中加载过，
+        计算耗时为 _get_metadata 的耗时
+        '''
+        stats = cls.__dict__.get('_cache_stats')
+        if stats is None:
+            stats = cache_registry.register(
+                'meta:%s.%s' % (cls.__module__, cls.__name__))
+            cls._cache_stats = stats
+        return stats
+
+    @classmethod
+    def stats(cls):
+        return cls.cache_stats().snapshot()
+
     def __init__(self, ids=None, obj_type='int', field_name='id',
                  is_refresh=False):
         """
@@ -100,12 +845,15 @@ class CacheMeta(object):
         if not ids_set:
             return ''
 
+        start = time.time()
         try:
             metas = self._get_metadata(*ids_set)
         except:
             raise
         else:
             setattr(g, self.meta_ids, set([]))
+        finally:
+            self.cache_stats().observe(time.time() - start)
 
         try:
             _metas = getattr(g, self.meta_name, {})
@@ -118,7 +866,10 @@ class CacheMeta(object):
     def _meta_values(self, id):
         if (not hasattr(g, self.meta_name) or
                 id not in getattr(g, self.meta_name)):
+            self.cache_stats().incr('misses')
             self.preload_meta()
+        else:
+            self.cache_stats().incr('hits')
 
         try:
             return getattr(g, self.meta_name)[id]
@@ -126,6 +877,84 @@ class CacheMeta(object):
             return {}
 
 
+class MemcacheMeta(CacheMeta):
+    """
+    先从 memcache 批量读取，未命中的再用一次 IN 查询从数据库加载并写回
+
+    preload N 个 id 最多三次请求: get_many、一次 SQL、set_many。
+    数据库中不存在的 id 在本次请求内记为 {}，不会重复查询。
+    memcache 的命中和未命中记在统计的 shared_hits/shared_misses 中
+
+    子类需要指定 model、meta_name、meta_ids，例如:
+
+        class AccountMeta(MemcacheMeta):
+            model = Account
+            meta_name = '_account_metas'
+            meta_ids = '_account_meta_ids'
+            columns = ('id', 'nickname', '_avatar')
+
+    :Class Attributes
+        - model 数据库模型
+        - model_field 按这个字段查询数据库，默认为 id
+        - columns 缓存的字段，默认为全部字段
+        - cache_ttl 缓存时间(秒)
+        - store 缓存存储，默认为 MemcacheStore
+    """
+
+    model = None
+    model_field = 'id'
+    columns = None
+    cache_ttl = 3600
+    store = MemcacheStore()
+
+    @classmethod
+    def cache_key(cls, id):
+        return cls.store.make_key(cls.meta_name,
+                                  six.text_type(id).encode('utf-8'))
+
+    @classmethod
+    def invalidate(cls, *ids):
+        '''数据修改后调用，删除对应的缓存'''
+        for id in ids:
+            cls.store.delete(cls.cache_key(id))
+
+    def dump(self, obj):
+        '''模型对象转成缓存的数据'''
+        columns = self.columns or [
+            c.key for c in self.model.__mapper__.column_attrs]
+        return dict((c, getattr(obj, c)) for c in columns)
+
+    def load(self, ids):
+        '''从数据库加载，返回 {id: meta}，id 为字符串形式'''
+        column = getattr(self.model, self.model_field)
+        objs = self.model.query.filter(column.in_(ids)).all()
+        return dict((six.text_type(getattr(obj, self.model_field)),
+                     self.dump(obj)) for obj in objs)
+
+    def _get_metadata(self, *ids):
+        keys = dict((self.cache_key(id), id) for id in ids)
+        cached = self.store.get_many(list(keys))
+        metas = dict((keys[key], value) for key, value in six.iteritems(cached))
+        missing = [id for id in ids if id not in metas]
+        stats = self.cache_stats()
+        stats.incr('shared_hits', len(metas))
+        stats.incr('shared_misses', len(missing))
+        if not missing:
+            return metas
+
+        loaded = self.load(missing)
+        values = {}
+        for id in missing:
+            meta = loaded.get(six.text_type(id))
+            if meta is None:
+                metas[id] = {}
+                continue
+            metas[id] = meta
+            values[self.cache_key(id)] = meta
+        self.store.set_many(values, self.cache_ttl)
+        return metas
+
+
 class Memcache(object):
 
     def __init__(self, app=None, strict=False):
@@ -153,4 +982,6 @@ class Memcache(object):
         return getattr(self._memc_client, name)
 
 
-__all__ = [Memcache, cache_for, CacheMeta]
+__all__ = [make_key, stable_dumps, code_version, CacheStats, CacheRegistry,
+           cache_registry, Memcache, MemoryStore, SharedStore, MemcacheStore, RedisStore,
+           InFlight, cache_for, CacheMeta, MemcacheMeta]
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+import threading
+
+from flask import Flask, g
+from mockredis import mock_strict_redis_client
+
+from zaih_core.caching import (
+    MemoryStore, MemcacheStore, RedisStore, MemcacheMeta, cache_for,
+    make_key, stable_dumps, code_version, cache_registry, CacheRegistry)
+from zaih_core.mock_memcache import MockMemcache
+
+
+def test_memory_store_lru():
+    store = MemoryStore(max_entries=2, max_bytes=0)
+    store.set('a', 1, 200, now=100)
+    store.set('b', 2, 200, now=100)
+    assert store.get('a', now=100) == 1
+    store.set('c', 3, 200, now=100)
+    # b 最久未使用，被淘汰
+    assert store.get('b', now=100) is None
+    assert store.get('a', now=100) == 1
+    assert store.get('c', now=100) == 3
+    assert store.evictions == 1
+    assert len(store) == 2
+
+
+def test_memory_store_max_bytes():
+    store = MemoryStore(max_entries=100, max_bytes=200)
+    for i in range(10):
+        store.set('key%s' % i, 'x' * 50, 200, now=100)
+    assert store.bytes <= 200
+    assert store.evictions > 0
+    # 单条超过上限的数据不缓存
+    assert not store.set('big', 'x' * 500, 200, now=100)
+    assert 'big' not in store
+
+
+def test_memory_store_expire():
+    store = MemoryStore(max_entries=10, sweep_interval=10)
+    store.set('a', 1, 110, now=100)
+    store.set('b', 2, 200, now=100)
+    assert store.get('a', now=120) is None
+    assert store.expirations == 1
+    store.set('c', 3, 110, now=100)
+    # 超过 sweep_interval 后写入会清理过期数据
+    store.set('d', 4, 300, now=150)
+    assert 'c' not in store
+    assert store.stats()['entries'] == 2
+
+
+def test_cache_for():
+    calls = []
+
+    @cache_for(60, store=MemoryStore(max_entries=2))
+    def double(x):
+        calls.append(x)
+        return x * 2
+
+    assert double(1) == 2
+    assert double(1) == 2
+    assert calls == [1]
+    double(2)
+    double(3)
+    assert double.cache.evictions == 1
+    assert len(double.cache) == 2
+
+
+def test_cache_for_shared():
+    for shared in (MemcacheStore(MockMemcache()),
+                   RedisStore(mock_strict_redis_client())):
+        calls = []
+
+        def load(x):
+            calls.append(x)
+            return {'x': x, 'data': 'y' * 2000}
+
+        # 两个进程各自的进程内缓存，共用同一个共享缓存
+        worker1 = cache_for(60, shared=shared, namespace='load')(load)
+        worker2 = cache_for(60, shared=shared, namespace='load')(load)
+        assert worker1(1) == worker2(1)
+        assert calls == [1]
+        assert len(worker2.cache) == 1
+        worker2(2)
+        assert calls == [1, 2]
+
+
+def test_shared_store_serialize():
+    store = MemcacheStore(MockMemcache(), compress_min_size=100)
+    small, big = [1, 2], 'x' * 1000
+    assert store.dumps(small)[:1] == b'p'
+    assert store.dumps(big)[:1] == b'z'
+    assert store.loads(store.dumps(small)) == small
+    assert store.loads(store.dumps(big)) == big
+
+
+def test_cache_for_coalescing():
+    calls = []
+    release = threading.Event()
+
+    @cache_for(60)
+    def slow(x):
+        calls.append(x)
+        release.wait(5)
+        return x
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(slow(1)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    release.set()
+    for t in threads:
+        t.join()
+    assert calls == [1]
+    assert results == [1] * 5
+
+
+class BusyStore(RedisStore):
+    """模拟其他进程正在计算: busy 为 True 时拿不到锁"""
+
+    busy = False
+
+    def acquire(self, key, ttl):
+        return not self.busy and super(BusyStore, self).acquire(key, ttl)
+
+
+def test_cache_for_shared_lock():
+    shared = BusyStore(mock_strict_redis_client())
+    calls = []
+
+    def load(x):
+        calls.append(x)
+        return x
+
+    worker1 = cache_for(60, shared=shared, namespace='lock')(load)
+    worker2 = cache_for(60, shared=shared, namespace='lock',
+                        lock_timeout=1)(load)
+    assert worker1(1) == 1
+    shared_key = worker1.shared_key(1)
+    shared.delete(shared_key)
+
+    # 其他进程持有锁，等待期间写入了结果
+    shared.busy = True
+    threading.Timer(0.2, lambda: shared.set(
+        shared_key, ('other', int(time.time()) + 60), 60)).start()
+    assert worker2(1) == 'other'
+    assert calls == [1]
+
+
+def test_cache_for_stale():
+    shared = BusyStore(mock_strict_redis_client())
+    calls = []
+
+    @cache_for(1, shared=shared, namespace='stale', stale=60)
+    def load(x):
+        calls.append(x)
+        return len(calls)
+
+    assert load(1) == 1
+    # 让进程内和共享缓存中的数据都过期，但仍在 stale 窗口内
+    key = list(load.cache._data.keys())[0]
+    value, expire, size = load.cache._data[key]
+    load.cache._data[key] = ((value[0], 0), expire, size)
+    shared_key = load.shared_key(1)
+    shared.set(shared_key, (1, 0), 60)
+
+    # 其他进程正在刷新，直接返回旧数据
+    shared.busy = True
+    assert load(1) == 1
+    assert calls == [1]
+    # 拿到锁后重新计算
+    shared.busy = False
+    assert load(1) == 2
+    assert load(1) == 2
+    assert calls == [1, 1]
+
+
+class CountingMemcache(object):
+    """记录每次请求的方法名"""
+
+    def __init__(self):
+        self.client = MockMemcache()
+        self.calls = []
+
+    def __getattr__(self, name):
+        self.calls.append(name)
+        return getattr(self.client, name)
+
+
+class PlayerMeta(MemcacheMeta):
+
+    meta_name = '_player_metas'
+    meta_ids = '_player_meta_ids'
+    store = MemcacheStore(CountingMemcache())
+    queries = []
+
+    def load(self, ids):
+        self.queries.append(sorted(ids))
+        return dict(('%s' % id, {'id': id}) for id in ids if id < 1000)
+
+
+def test_memcache_meta():
+    app = Flask(__name__)
+    client = PlayerMeta.store.client
+    with app.app_context():
+        g._player_meta_ids = set(range(200))
+        meta = PlayerMeta(ids=[1000])
+        assert meta._meta_values(5) == {'id': 5}
+        assert client.calls == ['get_many', 'set_many']
+        assert len(PlayerMeta.queries) == 1
+        # 其余 id 已经在本次请求中加载过，不存在的 id 也不会再查询
+        assert meta._meta_values(199) == {'id': 199}
+        assert meta._meta_values(1000) == {}
+        assert len(PlayerMeta.queries) == 1
+
+    with app.app_context():
+        PlayerMeta.invalidate(3)
+        meta = PlayerMeta(ids=range(5))
+        assert meta._meta_values(4) == {'id': 4}
+        assert PlayerMeta.queries[-1] == [3]
+        stats = PlayerMeta.stats()
+        assert (stats['shared_hits'], stats['shared_misses']) == (4, 202)
+
+
+def test_make_key():
+    assert make_key((1, 'a', None), {'b': 2}) == (1, 'a', None, ('b', 2))
+    # 复杂参数用摘要代替
+    key = make_key(({'x': [1, 2]},))
+    assert key[0][0] == '#'
+    assert key == make_key(({'x': [1, 2]},))
+    assert key != make_key(({'x': [2, 1]},))
+    # 共享缓存的 key 和 dict/set 的顺序无关
+    assert (stable_dumps({'x': 1, 'y': set([3, 4])}) ==
+            stable_dumps({'y': set([4, 3]), 'x': 1}))
+
+
+def test_make_key_types():
+    @cache_for(60)
+    def f(x):
+        return repr(x)
+
+    # 相等且 hash 相同的不同类型不能共用缓存
+    assert [f(1), f(True), f(1.0)] == ['1', 'True', '1.0']
+    assert make_key((1,)) != make_key((True,))
+    assert make_key((), {'x': 1}) != make_key((), {'x': 1.0})
+
+
+def test_memory_store_key_size():
+    store = MemoryStore(max_bytes=1000)
+    assert not store.set(('f', 'x' * 5000), 1, 200, now=100)
+    store.set(('f', 'x' * 500), 1, 200, now=100)
+    assert store.bytes > 500
+
+
+def test_cache_for_version():
+    def load(x):
+        return x + 1
+
+    def load_changed(x):
+        return x + 2
+
+    assert code_version(load) != code_version(load_changed)
+    fn = cache_for(60, namespace='load')(load)
+    assert fn.prefix == 'load:%s' % code_version(load)
+    fn = cache_for(60, namespace='load', version='2')(load)
+    assert fn.prefix == 'load:2'
+    assert fn(1) == 2
+    assert list(fn.cache._data.keys()) == [('load:2', 1)]
+
+
+def test_cache_for_no_stale():
+    shared = BusyStore(mock_strict_redis_client())
+    calls = []
+
+    @cache_for(60, shared=shared, namespace='no_stale', lock_timeout=0.2)
+    def load(x):
+        calls.append(x)
+        return len(calls)
+
+    # 共享缓存中已经过期的数据，stale=0 时不能返回
+    shared.set(load.shared_key(1), (100, int(time.time()) - 1), 60)
+    shared.busy = True
+    assert load(1) == 1
+    assert calls == [1]
+
+
+def test_cache_stats():
+    store = MemoryStore(max_entries=1)
+
+    @cache_for(60, store=store, namespace='stats', stale=60)
+    def load(x):
+        return x
+
+    load(1)
+    load(1)
+    load(2)
+    assert cache_registry.get('stats') is load.stats
+    data = cache_registry.snapshot()['stats']
+    assert (data['hits'], data['misses']) == (1, 2)
+    assert data['hit_ratio'] == 0.3333
+    assert (data['entries'], data['evictions']) == (1, 1)
+    assert data['latency']['count'] == 2
+    assert data['latency']['buckets'][0] == ['0.001', 2]
+
+    metrics = dict(((name, labels.get('le')), value)
+                   for name, labels, value in cache_registry.collect()
+                   if labels['cache'] == 'stats')
+    assert metrics[('cache_hits_total', None)] == 1
+    assert metrics[('cache_compute_seconds_bucket', '+Inf')] == 2
+
+    client = mock_strict_redis_client()
+    assert cache_registry.publish(client, 'stats', interval=60)
+    assert not cache_registry.publish(client, 'stats', interval=60)
+    published = list(cache_registry.published(client, 'stats').values())
+    assert published[0]['caches']['stats']['hits'] == 1
+
+    # 已经退出的进程从 hash 中删除
+    client.hset('stats', 'gone:1', json.dumps({'timestamp': 0, 'caches': {}}))
+    assert 'gone:1' not in cache_registry.published(client, 'stats')
+    assert client.hlen('stats') == 1
+
+
+def test_stats_sources():
+    registry = CacheRegistry()
+    registry.register_source('http', lambda: {'api.example.com': 3})
+    registry.register_source('broken', lambda: 1 / 0)
+    # 出错的统计被忽略，不影响其他统计
+    assert registry.sources() == {'http': {'api.example.com': 3}}
+
+    client = mock_strict_redis_client()
+    assert registry.publish(client, 'sources')
+    published = list(registry.published(client, 'sources').values())
+    assert published[0]['sources']['http'] == {'api.example.com': 3}
@@ -2,6 +2,7 @@
 from __future__ import unicode_literals
 
 import copy
+import uuid
 import random
 
 import redis
@@ -51,6 +52,8 @@ class ZaihRedis(object):
                 slave_config['db'] = server['db']
                 self.connections.setdefault('slaves', []).append(
                     redis.StrictRedis(**slave_config))
+        else:
+            self.connections[name] = redis.StrictRedis(**server)
 
     def __getattr__(self, method):
         server = self.get_server(method)
@@ -126,4 +129,48 @@ class ZRedis(object):
         return getattr(self._redis_client, name)
 
 
-__all__ = [ZRedis, ZaihRedis, SentinelRedis]
+class RedisLock(object):
+    """
+    基于 SET NX PX 的简单分布式锁，timeout 秒后自动释放
+
+    lock = RedisLock(redis, 'lock:foo', timeout=10)
+    if lock.acquire():
+        try:
+            ...
+        finally:
+            lock.release()
+    """
+
+    def __init__(self, client, name, timeout=10):
+        self.client = client
+        self.name = name
+        self.timeout = timeout
+        self.token = None
+
+    def acquire(self):
+        token = uuid.uuid4().hex
+        if self.client.set(self.name, token, nx=True,
+                           px=int(self.timeout * 1000)):
+            self.token = token
+            return True
+        return False
+
+    def release(self):
+        # 只释放自己持有的锁，锁超时后可能已经被别人拿到。
+        # WATCH 之后比较，在 MULTI 中删除: 比较之后锁被别人修改时
+        # 事务不执行，不会删掉别人的锁
+        if self.token is None:
+            return
+        token, self.token = self.token.encode('ascii'), None
+        with self.client.pipeline() as p:
+            try:
+                p.watch(self.name)
+                if p.get(self.name) == token:
+                    p.multi()
+                    p.delete(self.name)
+                    p.execute()
+            except redis.WatchError:
+                pass
+
+
+__all__ = [ZRedis, ZaihRedis, SentinelRedis, RedisLock]
@@ -7,22 +7,26 @@ from werkzeug.utils import import_string
 from zaih_core.database import db, migrate
 
 from src.settings import Config
+from src.extensions import redis, memc
 
 import models
 
 blueprints = [
 ]
 
+CACHE_STATS_KEY = 'lt:cache:stats'
+
 
 def create_app(register_bp=True, test=False):
     app = Flask(__name__, static_folder='static')
+    app.config.from_object(Config)
     if test:
         app.config['TESTING'] = True
-    app.config.from_object(Config)
     if register_bp:
         register_blueprints(app)
     register_extensions(app)
     register_before_request(app)
+    register_after_request(app)
     return app
 
 
@@ -30,6 +34,8 @@ def register_extensions(app):
     db.init_app(app)
     db.app = app
     migrate.init_app(app, db)
+    redis.init_app(app)
+    memc.init_app(app)
 
 
 def register_blueprints(app):
@@ -48,3 +54,16 @@ def register_before_request(app):
         g.ip = request.headers.get('x-forwarded-for') or request.remote_addr
 
     app.before_request(get_request_ip)
+
+
+def register_after_request(app):
+
+    def publish_cache_stats(response):
+        from zaih_core.caching import cache_registry
+        # 每个进程最多每 CACHE_STATS_INTERVAL 秒写一次
+        cache_registry.publish(redis, CACHE_STATS_KEY,
+                               ttl=Config.CACHE_STATS_INTERVAL * 3,
+                               interval=Config.CACHE_STATS_INTERVAL)
+        return response
+
+    app.after_request(publish_cache_stats)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from zaih_core.caching import Memcache
+from zaih_core.zredis import ZRedis
+
+redis = ZRedis()
+memc = Memcache()
@@ -1,20 +1,34 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-from sqlalchemy import sql
+from sqlalchemy import sql, event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
+from redis.exceptions import RedisError
 
 import time
-from flask import g
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from flask import g, current_app as app
 from flask.ext.login import UserMixin
 
 from zaih_core.database import (Model, SurrogatePK, DateTime, db)
-from zaih_core.caching import cache_for
+from zaih_core.caching import (cache_for, cache_registry, MemcacheMeta,
+                               MemcacheStore)
+
+from src.extensions import redis
+from src.settings import Config
 
 
 __all__ = [
     'Account',
+    'AccountMeta',
 ]
 
 
+account_cache_stats = cache_registry.register('account')
+
+
 class Account(SurrogatePK, UserMixin, Model):
     __tablename__ = 'account'
 
@@ -31,6 +45,48 @@ class Account(SurrogatePK, UserMixin, Model):
                              index=True, nullable=False,
                              server_default=db.func.current_timestamp())
 
+    @staticmethod
+    def cache_key(id):
+        return 'lt:account:%s' % id
+
+    @classmethod
+    def get_cached(cls, id):
+        '''
+        按 id 获取用户，先查 redis 缓存(ACCOUNT_CACHE_TTL 秒)
+
+        缓存的是字段值，取出后 merge 到当前 session，不会产生 SQL。
+        统计记录在 cache_registry 的 account 中
+        '''
+        if id is None:
+            return None
+        try:
+            value = redis.get(cls.cache_key(id))
+        except RedisError as e:
+            app.logger.warning('account cache get failed: %s', e)
+            account_cache_stats.incr('errors')
+            account_cache_stats.incr('misses')
+            return cls.query.get(id)
+        if value is not None:
+            account_cache_stats.incr('hits')
+            account = cls(**pickle.loads(value))
+            make_transient_to_detached(account)
+            return db.session.merge(account, load=False)
+        account_cache_stats.incr('misses')
+        start = time.time()
+        account = cls.query.get(id)
+        account_cache_stats.observe(time.time() - start)
+        if account is not None:
+            values = dict((attr.key, getattr(account, attr.key))
+                          for attr in inspect(cls).column_attrs)
+            try:
+                redis.set(cls.cache_key(id),
+                          pickle.dumps(values, pickle.HIGHEST_PROTOCOL),
+                          ex=Config.ACCOUNT_CACHE_TTL)
+            except RedisError as e:
+                app.logger.warning('account cache set failed: %s', e)
+                account_cache_stats.incr('errors')
+        return account
+
     @property
     def avatar(self):
         return self._avatar
@@ -46,3 +102,58 @@ class Account(SurrogatePK, UserMixin, Model):
         if auth:
             return auth.openid
         return ""
+
+
+class AccountMeta(MemcacheMeta):
+    '''
+    列表页批量加载用户信息
+
+        AccountMeta(ids=rows, field_name='account_id').preload_meta()
+        AccountMeta()._meta_values(row['account_id'])
+    '''
+
+    model = Account
+    meta_name = '_account_metas'
+    meta_ids = '_account_meta_ids'
+    columns = ('id', 'nickname', 'realname', '_avatar', 'title',
+               'is_verified')
+    cache_ttl = Config.ACCOUNT_CACHE_TTL
+    store = MemcacheStore(namespace='lt')
+
+
+def invalidate_after_commit(*ids):
+    '''
+    当前事务提交后再删除这些用户的缓存
+
+    flush 时就删除的话，并发的 get_cached 仍然会读到旧记录并重新写入缓存，
+    事务回滚时也会白白清掉缓存
+    '''
+    pending = db.session.info.setdefault('invalid_account_ids', set())
+    pending.update(id for id in ids if id is not None)
+
+
+@event.listens_for(Account, 'after_update')
+@event.listens_for(Account, 'after_delete')
+def clear_account_cache(mapper, connection, target):
+    invalidate_after_commit(target.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_accounts(session):
+    # savepoint 提交时外层事务还没有提交
+    if session.transaction.nested:
+        return
+    ids = session.info.pop('invalid_account_ids', None)
+    if not ids:
+        return
+    try:
+        redis.delete(*[Account.cache_key(id) for id in ids])
+    except RedisError as e:
+        app.logger.warning('account cache delete failed: %s', e)
+    AccountMeta.invalidate(*ids)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_accounts(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('invalid_account_ids', None)
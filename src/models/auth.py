@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 import json
 from datetime import timedelta, datetime
-from sqlalchemy import sql
+from sqlalchemy import sql, event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from zaih_core.database import (Model, SurrogatePK, DateTime, db,
@@ -26,6 +28,8 @@ class WXAuthentication(SurrogatePK, Model):
     __tablename__ = 'wx_authentication'
     __table_args__ = (
         db.UniqueConstraint('account_id', 'client', 'openid_type'),
+        db.Index('ix_wx_authentication_openid_openid_type',
+                 'openid', 'openid_type'),
     )
 
     unionid = db.Column(db.String(64), nullable=True)
@@ -49,8 +53,14 @@ class WXAuthentication(SurrogatePK, Model):
 class OAuth2Token(Model):
 
     __tablename__ = 'oauth2_token'
+    __table_args__ = (
+        db.Index('ix_oauth2_token_client_id_account_id',
+                 'client_id', 'account_id', unique=True),
+    )
 
     EXPIRE_DAY = 7
+    # 剩余有效期超过这个时间(秒)的 token 登录时直接复用
+    REUSE_EXPIRES_IN = 3600*24
 
     id = db.Column(db.Integer, primary_key=True)
     client_id = db.Column(db.String(40), nullable=False)
@@ -59,7 +69,7 @@ class OAuth2Token(Model):
     session_key = db.Column(db.String(40), nullable=True)
     access_token = db.Column(db.String(255), unique=True)
     refresh_token = db.Column(db.String(255), unique=True)
-    expires = db.Column(db.DateTime)
+    expires = db.Column(db.DateTime, index=True)
     scopes = db.Column(JsonString(1024))
 
     account = db.relationship(
@@ -69,8 +79,9 @@ class OAuth2Token(Model):
 
     @hybrid_property
     def expires_timestamp(self):
-        import time
-        et = time.mktime(self.expires.utctimetuple())
+        # expires 存的是 utc 时间，不能用 time.mktime 按本地时间换算
+        import calendar
+        et = calendar.timegm(self.expires.utctimetuple())
         return et
 
     @hybrid_property
@@ -94,12 +105,12 @@ class OAuth2Token(Model):
     @classmethod
     def get_token_info(cls, token, is_refresh_token=False):
         if is_refresh_token:
+            # 用 refresh token 换新的 token，原记录原地更新
             token = cls.query.filter_by(refresh_token=token).first()
-            if token.is_refresh_token_expired():
-                token = cls.get_or_create(token.client_id,
-                                          token.account_id, token.token_type)
-                return token.as_dict()
-            return None
+            if not token or token.is_refresh_token_expired():
+                return None
+            token.rotate()
+            return token.as_dict()
         else:
             token = cls.query.filter_by(access_token=token).first()
             if not token or token.is_expired():
@@ -108,21 +119,106 @@ class OAuth2Token(Model):
 
     @classmethod
     def get_or_create(cls, client_id, account_id, session_key=None,
-                      token_type='Bearer'):
-        # get or create valid access token
-        token = None
-        if not token or token.is_expired():
-            from oauthlib.common import generate_token
-            token = cls.create(client_id=client_id,
-                               account_id=account_id,
-                               token_type=token_type,
-                               session_key=session_key,
-                               expires_in=3600*24*cls.EXPIRE_DAY,
-                               access_token=generate_token(),
-                               refresh_token=generate_token(),
-                               scopes=["open"])
+                      token_type='Bearer', commit=True):
+        # 每个 (client_id, account_id) 只保留一条记录(有唯一索引)
+        # 剩余有效期足够时直接复用，否则原地换新的 token
+        token = cls._get_for_update(client_id, account_id)
+        if token is None:
+            token = cls._create(client_id, account_id, session_key,
+                                token_type)
+            if token is not None:
+                token.save(commit=commit)
+                return token
+            # 并发的首次登录已经插入了记录，改为复用它
+            token = cls._get_for_update(client_id, account_id)
+        if session_key:
+            token.session_key = session_key
+        if token.expires_in > cls.REUSE_EXPIRES_IN:
+            token.save(commit=commit)
+        else:
+            token.rotate(commit=commit)
         return token
 
+    @classmethod
+    def _get_for_update(cls, client_id, account_id):
+        return (cls.query
+                .filter_by(client_id=client_id, account_id=account_id)
+                .with_for_update()
+                .first())
+
+    @classmethod
+    def _create(cls, client_id, account_id, session_key, token_type):
+        '''在 savepoint 中插入新记录，违反唯一索引时返回 None'''
+        from oauthlib.common import generate_token
+        token = cls(client_id=client_id,
+                    account_id=account_id,
+                    token_type=token_type,
+                    session_key=session_key,
+                    expires_in=3600*24*cls.EXPIRE_DAY,
+                    refresh_token=generate_token(),
+                    scopes=["open"])
+        token.access_token = token.generate_access_token()
+        try:
+            with db.session.begin_nested():
+                db.session.add(token)
+        except IntegrityError:
+            return None
+        return token
+
+    def rotate(self, commit=True):
+        '''
+        原地更新 access token 和 refresh token，事务提交后旧的 access token
+        立即失效(commit=False 时在调用方提交后失效)
+
+        旧的签名 token 不能吊销时抛出 TokenRevokeError，调用方应回滚
+        '''
+        from oauthlib.common import generate_token
+        revoke_signed_token(self.access_token)
+        invalidate_after_commit(self.access_token)
+        self.expires_in = 3600*24*self.EXPIRE_DAY
+        self.refresh_token = generate_token()
+        self.access_token = self.generate_access_token()
+        self.save(commit=commit)
+        return self
+
+    @classmethod
+    def purge_expired(cls, batch_size=1000, start_id=0):
+        '''
+        按 id 顺序分批删除 refresh token 也已过期的记录
+
+        每批单独提交，产出 (本批删除数, 本批最大 id)，
+        中断后可以用最后的 id 作为 start_id 继续
+        '''
+        deadline = datetime.utcnow() - timedelta(days=cls.EXPIRE_DAY)
+        last_id = start_id
+        while True:
+            ids = [id for id, in (db.session.query(cls.id)
+                                  .filter(cls.id > last_id,
+                                          cls.expires < deadline)
+                                  .order_by(cls.id)
+                                  .limit(batch_size))]
+            if not ids:
+                break
+            (cls.query.filter(cls.id.in_(ids))
+             .delete(synchronize_session=False))
+            db.session.commit()
+            last_id = ids[-1]
+            yield len(ids), last_id
+
+    def generate_access_token(self):
+        # 开启 STATELESS_TOKEN 后签发签名 token，校验时不用查库
+        from oauthlib.common import generate_token
+        from src.services.stateless_token import stateless_token
+        if stateless_token.enabled:
+            return stateless_token.dumps(self.account_id, self.client_id,
+                                         self.scopes, self.expires_timestamp)
+        return generate_token()
+
+    def revoke(self):
+        revoke_signed_token(self.access_token)
+        invalidate_after_commit(self.access_token)
+        self.update(expires=datetime.utcnow())
+
     def as_dict(self):
         return {
             'client_id': self.client_id,
@@ -133,3 +229,43 @@ class OAuth2Token(Model):
             'expires_timestamp': self.expires_timestamp,
             'scopes': self.scopes,
         }
+
+
+def revoke_signed_token(token):
+    '''
+    签名 token 校验时不查库，换发或吊销前先写入吊销列表，失败时抛出
+    TokenRevokeError，不继续修改记录
+
+    写入吊销列表后事务回滚的话，用户需要重新登录，但旧 token 不会继续有效
+    '''
+    from src.services.stateless_token import stateless_token
+    if stateless_token.is_signed(token):
+        stateless_token.revoke(token)
+
+
+def invalidate_after_commit(*tokens):
+    '''
+    当前事务提交后再让这些 access token 失效
+
+    提交前失效的话，并发的 verify_token 仍然会读到旧记录并重新写入缓存
+    '''
+    pending = db.session.info.setdefault('invalid_access_tokens', set())
+    pending.update(token for token in tokens if token)
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_committed_tokens(session):
+    # savepoint 提交时外层事务还没有提交
+    if session.transaction.nested:
+        return
+    tokens = session.info.pop('invalid_access_tokens', None)
+    if not tokens:
+        return
+    from src.services.token_cache import token_info_cache
+    token_info_cache.invalidate(*tokens)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def discard_pending_tokens(session, previous_transaction):
+    if not previous_transaction.nested:
+        session.info.pop('invalid_access_tokens', None)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import json
+import socket
+import hashlib
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+from pymemcache.exceptions import MemcacheError
+from zaih_core.caching import cache_registry
+
+from src.extensions import redis, memc
+from src.settings import Config
+
+
+CACHE_ERRORS = (RedisError, MemcacheError, socket.error)
+
+
+class ResponseCache(object):
+    '''
+    接口响应缓存，存序列化好的 json 和压缩后的内容，按 tag 失效
+
+    - 每个 tag 有一个版本号，缓存写入时记录所用 tag 的版本号
+    - 读取时用一次 mget 同时取缓存和 tag 当前版本号，版本号不一致视为未命中
+    - invalidate(tag) 只需要把版本号加一，不用找出所有相关的缓存
+    - 后端可以是 redis 或 memcache，不可用时降级为不缓存
+    - 命中、未命中和后端出错次数记录在 cache_registry 的 response 中，
+      生成响应的耗时由 cache_response 记录
+    '''
+
+    prefix = 'lt:rc:'
+    tag_prefix = 'lt:rc:tag:'
+    # tag 版本号的过期时间，要远大于缓存本身的过期时间
+    tag_ttl = 3600 * 24 * 7
+
+    def __init__(self, backend=None, name='response'):
+        self.backend = backend or Config.RESPONSE_CACHE_BACKEND
+        self.stats = cache_registry.register(name)
+
+    @property
+    def client(self):
+        return memc if self.backend == 'memcache' else redis
+
+    def key(self, *parts):
+        raw = json.dumps(parts, sort_keys=True, separators=(',', ':'))
+        return self.prefix + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def _tag_key(self, tag):
+        return self.tag_prefix + tag
+
+    def _mget(self, keys):
+        if self.backend == 'memcache':
+            values = self.client.get_many(keys)
+            return [values.get(key) for key in keys]
+        return self.client.mget(keys)
+
+    def get(self, key, tags=()):
+        '''
+        返回 (entry, versions)，entry 为 (payload, etag, headers, variants)，
+        未命中时为 None
+
+        versions 是读取时 tag 的版本号，写入时原样传给 set，
+        这样生成响应期间发生的失效不会被覆盖
+        '''
+        try:
+            values = self._mget([key] + [self._tag_key(t) for t in tags])
+        except CACHE_ERRORS as e:
+            app.logger.warning('response cache get failed: %s', e)
+            self.stats.incr('errors')
+            self.stats.incr('misses')
+            return None, None
+        versions = tuple(values[1:])
+        if values[0] is None:
+            self.stats.incr('misses')
+            return None, versions
+        entry = pickle.loads(values[0])
+        if entry[0] != versions:
+            self.stats.incr('misses')
+            return None, versions
+        self.stats.incr('hits')
+        return entry[1:], versions
+
+    def set(self, key, versions, payload, etag, headers, variants, ttl):
+        if versions is None:
+            return
+        value = pickle.dumps((versions, payload, etag, headers, variants),
+                             pickle.HIGHEST_PROTOCOL)
+        try:
+            if self.backend == 'memcache':
+                self.client.set(key, value, expire=ttl)
+            else:
+                self.client.set(key, value, ex=ttl)
+        except CACHE_ERRORS as e:
+            app.logger.warning('response cache set failed: %s', e)
+            self.stats.incr('errors')
+
+    def invalidate(self, *tags):
+        '''让带有这些 tag 的缓存失效，在数据写入后调用'''
+        for tag in tags:
+            key = self._tag_key(tag)
+            try:
+                if self.backend == 'memcache':
+                    if self.client.incr(key, 1) is None:
+                        self.client.add(key, '1', expire=self.tag_ttl)
+                else:
+                    with self.client.pipeline(transaction=False) as p:
+                        p.incr(key)
+                        p.expire(key, self.tag_ttl)
+                        p.execute()
+            except CACHE_ERRORS as e:
+                app.logger.warning('response cache invalidate failed: %s', e)
+                self.stats.incr('errors')
+
+
+response_cache = ResponseCache()
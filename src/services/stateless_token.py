@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import hmac
+import json
+import time
+import base64
+import hashlib
+import binascii
+import os
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+
+from src.extensions import redis
+from src.settings import Config
+
+
+def _b64encode(s):
+    return base64.urlsafe_b64encode(s).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(s):
+    s = s.encode('ascii')
+    return base64.urlsafe_b64decode(s + b'=' * (-len(s) % 4))
+
+
+class TokenRevokeError(Exception):
+    '''签名 token 没能写入吊销列表，调用方不能继续换发 token'''
+
+
+class StatelessToken(object):
+    '''
+    自描述的签名 access token，校验时只需要 HMAC 和当前时间，不用查库
+
+    格式为 lt1.<payload>.<signature>，payload 为 base64 编码的 json:
+
+        a: account_id
+        c: client_id
+        s: scopes
+        e: 过期时间戳
+        j: token id，用于吊销
+
+    被吊销的 token id 存在 redis 的 sorted set 中，score 为过期时间，
+    过期后自动清理，所以吊销列表只包含还没过期的 token。
+    redis 不可用时按 oauth2_token 表判断是否吊销，不会放行旧 token
+
+    没有设置 TOKEN_SIGNING_KEY 时不签发签名 token，也不接受任何签名 token
+    '''
+
+    prefix = 'lt1'
+    revoked_key = 'lt:token:revoked'
+    revoke_attempts = 3
+
+    def __init__(self, client=None):
+        self.client = client or redis
+
+    @property
+    def signing_key(self):
+        return Config.TOKEN_SIGNING_KEY
+
+    @property
+    def enabled(self):
+        return Config.STATELESS_TOKEN == 'yes' and bool(self.signing_key)
+
+    def _sign(self, payload):
+        key = self.signing_key.encode('utf-8')
+        msg = ('%s.%s' % (self.prefix, payload)).encode('ascii')
+        return _b64encode(hmac.new(key, msg, hashlib.sha256).digest())
+
+    def is_signed(self, token):
+        return bool(token) and token.startswith(self.prefix + '.')
+
+    def dumps(self, account_id, client_id, scopes, expires_timestamp):
+        data = {
+            'a': account_id,
+            'c': client_id,
+            's': scopes,
+            'e': int(expires_timestamp),
+            'j': binascii.hexlify(os.urandom(8)).decode('ascii'),
+        }
+        payload = _b64encode(json.dumps(data, separators=(',', ':'))
+                             .encode('utf-8'))
+        return '%s.%s.%s' % (self.prefix, payload, self._sign(payload))
+
+    def loads(self, token):
+        '''校验签名和过期时间，成功返回 payload，否则返回 None'''
+        try:
+            prefix, payload, signature = token.split('.')
+        except (AttributeError, ValueError):
+            return None
+        if prefix != self.prefix or not self.signing_key:
+            return None
+        try:
+            if not hmac.compare_digest(signature.encode('ascii'),
+                                       self._sign(payload).encode('ascii')):
+                return None
+            data = json.loads(_b64decode(payload).decode('utf-8'))
+        except (TypeError, ValueError):
+            # UnicodeError 是 ValueError 的子类
+            return None
+        if not isinstance(data, dict) or data.get('e', 0) <= time.time():
+            return None
+        return data
+
+    def get_token_info(self, token):
+        data = self.loads(token)
+        if not data or self.is_revoked(token, data):
+            return None
+        return {
+            'client_id': data['c'],
+            'account_id': data['a'],
+            'access_token': token,
+            'refresh_token': None,
+            'session_key': None,
+            'expires_timestamp': data['e'],
+            'scopes': data['s'],
+        }
+
+    def is_revoked(self, token, data):
+        '''
+        每个带签名 token 的请求都会调用，redis 出错时不能放行，改为查库:
+        换发或者吊销过的 token 不再是记录中有效的 access_token
+        '''
+        try:
+            return self.client.zscore(self.revoked_key, data['j']) is not None
+        except RedisError as e:
+            app.logger.warning('revoked token check failed, use db: %s', e)
+        from src.models.auth import OAuth2Token
+        return OAuth2Token.get_token_info(token) is None
+
+    def revoke(self, token):
+        '''
+        把 token 加入吊销列表，token 无效或者已经过期时返回 False
+
+        redis 出错时重试，都失败时抛出 TokenRevokeError，否则旧 token
+        在过期前(最长 7 天)一直有效
+        '''
+        data = self.loads(token)
+        if not data:
+            return False
+        for attempt in range(1, self.revoke_attempts + 1):
+            now = time.time()
+            try:
+                with self.client.pipeline(transaction=False) as p:
+                    p.zremrangebyscore(self.revoked_key, '-inf', now)
+                    p.zadd(self.revoked_key, data['e'], data['j'])
+                    p.execute()
+                return True
+            except RedisError as e:
+                app.logger.warning('revoke token failed (%s/%s): %s',
+                                   attempt, self.revoke_attempts, e)
+                error = e
+                if attempt < self.revoke_attempts:
+                    time.sleep(0.05 * attempt)
+        raise TokenRevokeError(error)
+
+
+stateless_token = StatelessToken()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+import pytest
+from flask import Flask
+from redis.exceptions import RedisError
+from mockredis import mock_strict_redis_client
+
+from src.settings import Config
+from src.models.auth import OAuth2Token
+from src.services.stateless_token import StatelessToken, TokenRevokeError
+
+
+class BrokenRedis(object):
+    """所有命令都抛出 RedisError"""
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            raise RedisError('connection refused')
+        return command
+
+
+@pytest.fixture
+def app(monkeypatch):
+    monkeypatch.setattr(Config, 'STATELESS_TOKEN', 'yes')
+    monkeypatch.setattr(Config, 'TOKEN_SIGNING_KEY', 'test-key')
+    monkeypatch.setattr(StatelessToken, 'revoke_attempts', 2)
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+def make_token(signer):
+    return signer.dumps(1, 'XiaoChengXu', ['open'], time.time() + 3600)
+
+
+def test_revoke(app):
+    signer = StatelessToken(mock_strict_redis_client())
+    token = make_token(signer)
+    assert signer.get_token_info(token)['account_id'] == 1
+    assert signer.revoke(token)
+    assert signer.get_token_info(token) is None
+
+
+def test_is_revoked_uses_db_without_redis(app, monkeypatch):
+    signer = StatelessToken(BrokenRedis())
+    token = make_token(signer)
+    rows = {}
+    monkeypatch.setattr(OAuth2Token, 'get_token_info',
+                        classmethod(lambda cls, token: rows.get(token)))
+    # 已经换发过(记录中不是这个 token)，redis 不可用时也不能放行
+    assert signer.get_token_info(token) is None
+    rows[token] = {'account_id': 1}
+    assert signer.get_token_info(token)['account_id'] == 1
+
+
+def test_revoke_failure_stops_rotation(app, monkeypatch):
+    from src.services import stateless_token
+    signer = StatelessToken(BrokenRedis())
+    monkeypatch.setattr(stateless_token, 'stateless_token', signer)
+    token = make_token(signer)
+    with pytest.raises(TokenRevokeError):
+        signer.revoke(token)
+
+    row = OAuth2Token(access_token=token)
+    with pytest.raises(TokenRevokeError):
+        row.rotate(commit=False)
+    # 没有换发，旧 token 保持不变
+    assert row.access_token == token
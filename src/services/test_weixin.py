@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+
+import pytest
+from flask import Flask
+from redis.exceptions import RedisError
+from mockredis import mock_strict_redis_client
+
+from zaih_core.zredis import RedisLock
+
+from src.services import weixin
+from src.services.weixin import WXAPPAPI, WXAPPError, WXAccessTokenManager
+
+
+class FakeAPI(WXAPPAPI):
+    """client_credential 每次返回新的 token，记录调用次数"""
+
+    def __init__(self):
+        super(FakeAPI, self).__init__(appid='wx-test', app_secret='secret')
+        self.fetches = 0
+
+    def client_credential_for_access_token(self):
+        self.fetches += 1
+        return {'access_token': 'token%s' % self.fetches, 'expires_in': 7200}
+
+
+class BrokenRedis(object):
+    """所有命令都抛出 RedisError"""
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            raise RedisError('connection refused')
+        return command
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    with app.app_context():
+        yield app
+
+
+def save_token(manager, token, expires_in):
+    manager.client.set(manager.key, json.dumps(
+        {'access_token': token, 'expires_at': int(time.time()) + expires_in}))
+
+
+def test_access_token_shared(app):
+    api, client = FakeAPI(), mock_strict_redis_client()
+    assert WXAccessTokenManager(api, client).get() == 'token1'
+    assert WXAccessTokenManager(api, client).get() == 'token1'
+    assert api.fetches == 1
+    # 锁已经释放
+    assert client.get('%s:lock' % WXAccessTokenManager(api, client).key) is None
+
+
+def test_access_token_refresh_ahead(app):
+    api, client = FakeAPI(), mock_strict_redis_client()
+    manager = WXAccessTokenManager(api, client)
+    save_token(manager, 'old', WXAccessTokenManager.REFRESH_AHEAD - 10)
+
+    # 其他 worker 正在刷新时继续使用还没过期的 token
+    lock = RedisLock(client, manager.lock_key)
+    assert lock.acquire()
+    assert manager.get() == 'old'
+    assert api.fetches == 0
+    lock.release()
+
+    # 快过期时提前刷新
+    assert manager.get() == 'token1'
+    assert api.fetches == 1
+
+
+def test_access_token_invalid_retry(app, monkeypatch):
+    api, client = FakeAPI(), mock_strict_redis_client()
+    monkeypatch.setattr(weixin, 'redis', client)
+    save_token(WXAccessTokenManager(api), 'revoked', 7200)
+    used = []
+
+    def fetch(path, params, access_token):
+        used.append(access_token)
+        if access_token == 'revoked':
+            raise WXAPPError(40001, 'invalid credential')
+        return b'png'
+
+    monkeypatch.setattr(api, '_fetch_wxacode', fetch)
+    assert api.fetch_wxacode('unlimit', 'scene') == b'png'
+    # 微信返回 token 失效时强制刷新，用新的 token 重试一次
+    assert used == ['revoked', 'token1']
+    assert api.fetches == 1
+
+
+def test_access_token_without_redis(app):
+    api = FakeAPI()
+    assert WXAccessTokenManager(api, BrokenRedis()).get() == 'token1'
+    assert api.fetches == 1
+
+
+def test_getwxacode_cached(app, monkeypatch, tmpdir):
+    from src.settings import Config
+    api, client = FakeAPI(), mock_strict_redis_client()
+    monkeypatch.setattr(weixin, 'redis', client)
+    monkeypatch.setattr(Config, 'WXACODE_CACHE_DIR', str(tmpdir))
+    used = []
+
+    def fetch(path, params, access_token):
+        used.append((params['scene'], access_token))
+        return b'png'
+
+    monkeypatch.setattr(api, '_fetch_wxacode', fetch)
+    # 不传 access_token 时用共享的 token，结果缓存在磁盘上
+    assert api.getwxacodeunlimit(scene='table=1') == ('cG5n', 3)
+    assert api.getwxacodeunlimit(scene='table=1') == ('cG5n', 3)
+    assert used == [('table=1', 'token1')]
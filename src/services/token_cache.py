@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+import hashlib
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+from zaih_core.caching import cache_registry
+
+from src.extensions import redis
+from src.settings import Config
+
+
+class TokenInfoCache(object):
+    '''
+    跨进程共享的 access token 校验结果缓存
+
+    - 有效 token 缓存 token_info，过期时间不超过 token 本身的 expires
+    - 无效 token 缓存为 null，避免重复的无效 token 每次都查库
+    - redis 不可用时降级为直接查库
+    - 命中、未命中和 redis 出错次数记录在 cache_registry 的 token_info 中
+    '''
+
+    prefix = 'lt:token_info:'
+
+    def __init__(self, client=None, name='token_info'):
+        self.client = client or redis
+        self.stats = cache_registry.register(name)
+
+    def _key(self, token):
+        if not isinstance(token, bytes):
+            token = token.encode('utf-8')
+        return self.prefix + hashlib.sha1(token).hexdigest()
+
+    def get(self, token):
+        '''返回 (hit, token_info)，命中无效 token 时 token_info 为 None'''
+        try:
+            value = self.client.get(self._key(token))
+        except RedisError as e:
+            app.logger.warning('token info cache get failed: %s', e)
+            self.stats.incr('errors')
+            self.stats.incr('misses')
+            return False, None
+        if value is None:
+            self.stats.incr('misses')
+            return False, None
+        token_info = json.loads(value)
+        self.stats.incr('hits')
+        if token_info is None:
+            self.stats.incr('negative_hits')
+        return True, token_info
+
+    def set(self, token, token_info):
+        ttl = Config.TOKEN_INFO_CACHE_TTL
+        expires_timestamp = token_info.get('expires_timestamp')
+        if expires_timestamp:
+            ttl = min(ttl, int(expires_timestamp - time.time()))
+        if ttl <= 0:
+            return
+        self._set(token, json.dumps(token_info), ttl)
+
+    def set_invalid(self, token):
+        self._set(token, 'null', Config.TOKEN_INFO_NEGATIVE_CACHE_TTL)
+
+    def _set(self, token, value, ttl):
+        try:
+            self.client.set(self._key(token), value, ex=ttl)
+        except RedisError as e:
+            app.logger.warning('token info cache set failed: %s', e)
+            self.stats.incr('errors')
+
+    def invalidate(self, *tokens):
+        keys = [self._key(token) for token in tokens if token]
+        if not keys:
+            return
+        try:
+            self.client.delete(*keys)
+        except RedisError as e:
+            app.logger.warning('token info cache invalidate failed: %s', e)
+
+
+token_info_cache = TokenInfoCache()
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 import sys
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from requests.exceptions import (ConnectTimeout, ReadTimeout,
                                  ConnectionError)
 from urllib import urlencode
 
+from zaih_core.caching import cache_registry
+
 TIMEOUT = 2
 
 PY2 = sys.version_info[0] == 2
@@ -26,9 +32,131 @@ else:
         return x.decode(charset, errors)
 
 
+class HostStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, elapsed, error=False):
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+
+    def as_dict(self):
+        avg = self.total_time / self.requests if self.requests else 0
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'avg_ms': int(avg * 1000),
+            'max_ms': int(self.max_time * 1000),
+        }
+
+
 class Request(object):
+    """
+    调用第三方接口，每个 host 一个 keep-alive 的连接池
+
+    连接池大小、超时、重试次数通过 Request.configure 修改:
+
+        Request.configure(pool_maxsize=20, connect_timeout=0.5)
+
+    只对建立连接失败做重试，请求发出后不会重试(比如 jscode2session 的
+    code 只能用一次)
+    """
+
+    config = {
+        'pool_maxsize': 10,
+        'pool_block': False,
+        'connect_timeout': 1,
+        'read_timeout': TIMEOUT,
+        'max_retries': 2,
+        'backoff_factor': 0.1,
+    }
+    _sessions = {}
+    _stats = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, **kwargs):
+        with cls._lock:
+            cls.config = dict(cls.config, **kwargs)
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions = {}
+
+    @classmethod
+    def session(cls, protocal, host):
+        key = (protocal, host)
+        session = cls._sessions.get(key)
+        if session is not None:
+            return session
+        with cls._lock:
+            session = cls._sessions.get(key)
+            if session is None:
+                config = cls.config
+                retries = Retry(total=config['max_retries'],
+                                connect=config['max_retries'],
+                                read=0,
+                                backoff_factor=config['backoff_factor'])
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=config['pool_maxsize'],
+                                      pool_block=config['pool_block'],
+                                      max_retries=retries)
+                session = requests.Session()
+                session.mount('%s://' % protocal, adapter)
+                cls._sessions[key] = session
+                cls._stats.setdefault(host, HostStats())
+        return session
+
+    @classmethod
+    def request(cls, method, host, uri, protocal='https', timeout=None,
+                **kwargs):
+        if timeout is None:
+            timeout = (cls.config['connect_timeout'],
+                       cls.config['read_timeout'])
+        session = cls.session(protocal, host)
+        start = time.time()
+        error = True
+        try:
+            response = session.request(method, uri, timeout=timeout,
+                                       **kwargs)
+            error = False
+        except (ConnectTimeout, ReadTimeout):
+            raise ConnectionError('conntect_error '
+                                  'Failed to establish a new connection')
+        finally:
+            cls._stats[host].record(time.time() - start, error)
+        return response
+
     @classmethod
-    def get(cls, host, path, params, protocal='https', timeout=TIMEOUT,
+    def stats(cls):
+        """每个 host 的请求耗时和连接池使用情况"""
+        results = {}
+        for (protocal, host), session in cls._sessions.items():
+            info = cls._stats[host].as_dict()
+            adapter = session.get_adapter('%s://%s' % (protocal, host))
+            pools = adapter.poolmanager.pools
+            in_use = idle = 0
+            for key in pools.keys():
+                pool = pools[key]
+                free = pool.pool.qsize() if pool.pool else 0
+                in_use += pool.pool.maxsize - free if pool.pool else 0
+                idle += free
+            info['pool'] = {
+                'maxsize': cls.config['pool_maxsize'],
+                'in_use': in_use,
+                'idle': idle,
+            }
+            results[host] = info
+        return results
+
+    @classmethod
+    def get(cls, host, path, params, protocal='https', timeout=None,
             headers=None):
         uri = '%s://%s%s' % (protocal, host, path)
         str_parmas = {}
@@ -38,38 +166,27 @@ class Request(object):
             url_params = urlencode(str_parmas)
             if url_params:
                 uri = "%s?%s" % (uri, url_params)
-        try:
-            response = requests.get(uri, params, timeout=timeout,
-                                    headers=headers)
-        except (ConnectTimeout, ReadTimeout):
-            raise ConnectionError('conntect_error '
-                                  'Failed to establish a new connection')
-        return response
+        return cls.request('GET', host, uri, protocal, timeout,
+                           headers=headers)
 
     @classmethod
-    def post(cls, host, path, params, protocal='https', timeout=TIMEOUT,
+    def post(cls, host, path, params, protocal='https', timeout=None,
              headers=None):
         uri = '%s://%s%s' % (protocal, host, path)
         str_parmas = {}
         if params:
             for k, v in params.iteritems():
                 str_parmas[k] = text_type(v).encode('utf-8')
-        try:
-            response = requests.post(uri, json=str_parmas, timeout=timeout,
-                                     headers=headers)
-        except (ConnectTimeout, ReadTimeout):
-            raise ConnectionError('conntect_error '
-                                  'Failed to establish a new connection')
-        return response
+        return cls.request('POST', host, uri, protocal, timeout,
+                           json=str_parmas, headers=headers)
 
     @classmethod
-    def post_by_body(cls, host, path, body, protocal='https', timeout=TIMEOUT,
+    def post_by_body(cls, host, path, body, protocal='https', timeout=None,
                      headers=None):
         uri = '%s://%s%s' % (protocal, host, path)
-        try:
-            response = requests.post(uri, data=body, timeout=timeout,
-                                     headers=headers)
-        except (ConnectTimeout, ReadTimeout):
-            raise ConnectionError('conntect_error '
-                                  'Failed to establish a new connection')
-        return response
\ No newline at end of file
+        return cls.request('POST', host, uri, protocal, timeout,
+                           data=body, headers=headers)
+
+
+# 各个 host 的请求数、耗时和连接池，和缓存统计一起由 cache_stats 输出
+cache_registry.register_source('http', Request.stats)
@@ -1,9 +1,12 @@
+import time
+
 from flask import current_app as app
 
-from zaih_core.caching import cache_for
 from zaih_core.verification import get_authorization
 
 from src.models.auth import WXAuthentication, OAuth2Token
+from src.services.token_cache import token_info_cache
+from src.services.stateless_token import stateless_token
 from src.settings import Config
 
 def verify_client(token):
@@ -15,12 +18,21 @@ def verify_client(token):
     return False, None
 
 
-@cache_for(60)
 def verify_token(token):
+    # results are cached in redis by token_info_cache only, so that
+    # token_info_cache.invalidate() takes effect in every worker at once
     import sys
     print sys._getframe().f_code.co_filename, sys._getframe().f_code.co_name
 
-    token_info = OAuth2Token.get_token_info(token)
+    hit, token_info = token_info_cache.get(token)
+    if not hit:
+        start = time.time()
+        token_info = OAuth2Token.get_token_info(token)
+        token_info_cache.stats.observe(time.time() - start)
+        if token_info:
+            token_info_cache.set(token, token_info)
+        else:
+            token_info_cache.set_invalid(token)
     #print token_info
     if token_info:
         if isinstance(token_info, dict):
@@ -32,10 +44,20 @@ def verify_token(token):
     return False, None
 
 
+def verify_stateless_token(token):
+    # signature, expiry and revocation list only, no database lookup
+    token_info = stateless_token.get_token_info(token)
+    if token_info:
+        return True, token_info
+    return False, None
+
+
 def verify_request():
     authorization_type, token = get_authorization()
     if authorization_type == 'Basic':
         return verify_client(token)
     elif authorization_type == 'Bearer':
+        if stateless_token.is_signed(token):
+            return verify_stateless_token(token)
         return verify_token(token)
     return False, None
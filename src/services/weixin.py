@@ -1,10 +1,27 @@
 # -*- coding: utf-8 -*-
+import time
 import hashlib
 import base64
 from Crypto.Cipher import AES
 import json
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+from zaih_core.zredis import RedisLock
+
+from src.extensions import redis
 from src.services.utils import Request
 
+# access_token 无效或过期
+ACCESS_TOKEN_ERRORS = (40001, 40014, 42001)
+
+# 小程序码接口: (接口地址, 参数名)
+WXACODE_APIS = {
+    'code': ('/wxa/getwxacode', 'path'),  # 接口A
+    'unlimit': ('/wxa/getwxacodeunlimit', 'scene'),  # 接口B
+    'qrcode': ('/cgi-bin/wxaapp/createwxaqrcode', 'path'),  # 接口C
+}
+
 
 class WXAPPError(Exception):
     def __init__(self, code, description):
@@ -50,54 +67,180 @@ class WXAPPAPI(object):
                              content.get("errmsg", ""))
         return content
 
-    def getwxacode(self, access_token, page_path):
-        # 接口A 数量有限 A＋C 100000个
-        path = '/wxa/getwxacode?access_token=%s' % access_token
-        params = {
-            'path': page_path,
-        }
+    @property
+    def token_manager(self):
+        return WXAccessTokenManager(self)
+
+    def _post_wxacode(self, path, params, access_token=None):
+        # 不传 access_token 时使用 worker 间共享的 token，
+        # 微信返回 token 失效时强制刷新后重试一次
+        if access_token is not None:
+            return self._fetch_wxacode(path, params, access_token)
+        access_token = self.token_manager.get()
+        try:
+            return self._fetch_wxacode(path, params, access_token)
+        except WXAPPError as e:
+            if e.code not in ACCESS_TOKEN_ERRORS:
+                raise
+        access_token = self.token_manager.get(invalid_token=access_token)
+        return self._fetch_wxacode(path, params, access_token)
+
+    def _fetch_wxacode(self, path, params, access_token):
+        # 成功时返回图片内容，微信返回 json 时返回 dict
+        path = '%s?access_token=%s' % (path, access_token)
         response = Request.post(self.host, path, params)
+        if response.headers.get('Content-Type', '').startswith('image/'):
+            return response.content
         try:
             content = json.loads(response.content.decode())
-            if content.get('errcode', 0):
-                raise WXAPPError(content.get('errcode', 0),
-                                 content.get("errmsg", ""))
+        except ValueError:
+            # 返回的是图片
+            return response.content
+        if content.get('errcode', 0):
+            raise WXAPPError(content.get('errcode', 0),
+                             content.get("errmsg", ""))
+        return content
+
+    @staticmethod
+    def _encode_wxacode(content):
+        if isinstance(content, dict):
             return content, None
-        except:
-            return base64.standard_b64encode(response.content), len(response.content)
+        return base64.standard_b64encode(content), len(content)
+
+    def fetch_wxacode(self, kind, value, access_token=None, **options):
+        """
+        获取小程序码图片原始内容
+
+        :Parameters
+            - kind WXACODE_APIS 中的接口类型
+            - value 接口A/C 为 path，接口B 为 scene
+            - options 其他参数，比如 page、width
+        """
+        path, field = WXACODE_APIS[kind]
+        params = dict(options)
+        params[field] = value
+        content = self._post_wxacode(path, params, access_token)
+        if isinstance(content, dict):
+            raise WXAPPError(content.get('errcode', -1),
+                             content.get('errmsg', 'not an image'))
+        return content
 
+    def _get_wxacode(self, kind, value, access_token=None):
+        """
+        返回 (base64 图片, 长度)，微信返回 json 时返回 (dict, None)
 
-    def getwxacodeunlimit(self, access_token, scene):
+        不传 access_token 时通过 WXACodeService 获取: 先查磁盘缓存，
+        没有时用 worker 间共享的 token 请求微信，出错时抛出 WXAPPError
+        """
+        if access_token is None:
+            from src.services.wxacode import WXACodeService
+            content = WXACodeService(api=self).get(kind, value)
+        else:
+            path, field = WXACODE_APIS[kind]
+            content = self._post_wxacode(path, {field: value}, access_token)
+        return self._encode_wxacode(content)
+
+    def getwxacode(self, access_token=None, page_path=None):
+        # 接口A 数量有限 A＋C 100000个
+        return self._get_wxacode('code', page_path, access_token)
+
+    def getwxacodeunlimit(self, access_token=None, scene=None):
         # 接口B 数量无限 scene strint(32)
-        path = '/wxa/getwxacodeunlimit?access_token=%s' % access_token
-        params = {
-            'scene': scene,
-        }
-        response = Request.post(self.host, path, params)
-        try:
-            content = json.loads(response.content.decode())
-            if content.get('errcode', 0):
-                raise WXAPPError(content.get('errcode', 0),
-                                 content.get("errmsg", ""))
-            return content, None
-        except:
-            return base64.standard_b64encode(response.content), len(response.content)
+        return self._get_wxacode('unlimit', scene, access_token)
 
-    def createwxaqrcode(self, access_token, page_path):
+    def createwxaqrcode(self, access_token=None, page_path=None):
         # 接口C 数量有限 A＋C 100000个
-        path = '/cgi-bin/wxaapp/createwxaqrcode?access_token=%s' % access_token
-        params = {
-            'path': page_path,
+        return self._get_wxacode('qrcode', page_path, access_token)
+
+
+class WXAccessTokenManager(object):
+    """
+    小程序 client_credential access_token，多个 worker 通过 redis 共享
+
+    - 过期前 REFRESH_AHEAD 秒开始提前刷新
+    - 刷新时加分布式锁，只有拿到锁的 worker 请求微信，
+      其他 worker 继续使用还没过期的 token，没有可用 token 时等待刷新结果
+    - redis 不可用时直接请求微信，不共享(和 token_cache 降级为查库一样)
+    """
+
+    REFRESH_AHEAD = 300
+    LOCK_TIMEOUT = 10
+    WAIT_TIMEOUT = 5
+    WAIT_INTERVAL = 0.1
+
+    def __init__(self, api, client=None):
+        self.api = api
+        self.client = client or redis
+        self.key = 'lt:wxapp:access_token:%s' % api.appid
+        self.lock_key = '%s:lock' % self.key
+
+    def _load(self):
+        value = self.client.get(self.key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def _is_usable(self, cached, invalid_token=None, ahead=0):
+        return (cached is not None and
+                cached['access_token'] != invalid_token and
+                cached['expires_at'] - ahead > time.time())
+
+    def get(self, invalid_token=None):
+        try:
+            return self._get(invalid_token)
+        except RedisError as e:
+            app.logger.warning('wxapp access token cache failed: %s', e)
+            return self.api.client_credential_for_access_token()[
+                'access_token']
+
+    def _get(self, invalid_token=None):
+        cached = self._load()
+        if self._is_usable(cached, invalid_token, self.REFRESH_AHEAD):
+            return cached['access_token']
+
+        lock = RedisLock(self.client, self.lock_key, self.LOCK_TIMEOUT)
+        if lock.acquire():
+            try:
+                # 拿到锁之后再检查一次，可能已经被其他 worker 刷新过
+                cached = self._load()
+                if self._is_usable(cached, invalid_token, self.REFRESH_AHEAD):
+                    return cached['access_token']
+                return self.refresh()
+            finally:
+                self._release(lock)
+
+        # 其他 worker 正在刷新
+        if self._is_usable(cached, invalid_token):
+            return cached['access_token']
+        deadline = time.time() + self.WAIT_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(self.WAIT_INTERVAL)
+            cached = self._load()
+            if self._is_usable(cached, invalid_token):
+                return cached['access_token']
+        return self.refresh()
+
+    def _release(self, lock):
+        # 释放失败时锁在 LOCK_TIMEOUT 后自动过期，不影响已经拿到的 token
+        try:
+            lock.release()
+        except RedisError as e:
+            app.logger.warning('wxapp access token unlock failed: %s', e)
+
+    def refresh(self):
+        content = self.api.client_credential_for_access_token()
+        expires_in = int(content.get('expires_in', 7200))
+        value = {
+            'access_token': content['access_token'],
+            'expires_at': int(time.time()) + expires_in,
         }
-        response = Request.post(self.host, path, params)
+        # 微信换发后旧 token 很快失效，写入失败时也要返回新 token，
+        # 不能再请求一次
         try:
-            content = json.loads(response.content.decode())
-            if content.get('errcode', 0):
-                raise WXAPPError(content.get('errcode', 0),
-                                 content.get("errmsg", ""))
-            return content, None
-        except:
-            return base64.standard_b64encode(response.content), len(response.content)
+            self.client.set(self.key, json.dumps(value), ex=expires_in)
+        except RedisError as e:
+            app.logger.warning('wxapp access token save failed: %s', e)
+        return value['access_token']
 
 
 class WXBizDataCrypt:
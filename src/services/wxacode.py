@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import json
+import errno
+import hashlib
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from requests import RequestException
+
+from src.settings import Config
+from src.services.weixin import WXAPPAPI, WXAPPError
+
+
+class WXACodeCache(object):
+    '''
+    小程序码图片的磁盘缓存
+
+    按 (appid, 接口类型, scene/path, 其他参数) 的 sha1 存储，
+    文件内容就是微信返回的 png，取出后不需要再编码
+    '''
+
+    def __init__(self, root=None):
+        self.root = root or Config.WXACODE_CACHE_DIR
+
+    def key(self, appid, kind, value, options=None):
+        raw = json.dumps([appid, kind, value, options or {}],
+                         sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], '%s.png' % key)
+
+    def get(self, key):
+        try:
+            with open(self.path(key), 'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def set(self, key, content):
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # 先写临时文件再 rename，避免读到写了一半的图片
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+
+class WXACodeService(object):
+    '''
+    带缓存的小程序码获取
+
+    单个获取: service.get('unlimit', 'table=12')
+    批量获取: service.get_many('unlimit', scenes, concurrency=4)
+    '''
+
+    def __init__(self, api=None, cache=None):
+        self.api = api or WXAPPAPI(appid=Config.WXAPP_APPID,
+                                   app_secret=Config.WXAPP_SECRET)
+        self.cache = cache or WXACodeCache()
+
+    def _key(self, kind, value, options):
+        return self.cache.key(self.api.appid, kind, value, options)
+
+    def get(self, kind, value, **options):
+        key = self._key(kind, value, options)
+        content = self.cache.get(key)
+        if content is None:
+            content = self.api.fetch_wxacode(kind, value, **options)
+            self.cache.set(key, content)
+        return content
+
+    def get_many(self, kind, values, concurrency=4, **options):
+        '''
+        返回 (results, errors)，results 为 {value: png}，
+        errors 为 {value: WXAPPError 或 RequestException}，
+        单个失败不影响其他的，已缓存的不会请求微信
+        '''
+        results = {}
+        missing = []
+        for value in values:
+            content = self.cache.get(self._key(kind, value, options))
+            if content is None:
+                missing.append(value)
+            else:
+                results[value] = content
+
+        def fetch(value):
+            try:
+                return value, self.get(kind, value, **options), None
+            except (WXAPPError, RequestException) as e:
+                return value, None, e
+
+        errors = {}
+        if missing:
+            pool = ThreadPool(min(concurrency, len(missing)))
+            try:
+                for value, content, error in pool.imap_unordered(fetch,
+                                                                 missing):
+                    if error is None:
+                        results[value] = content
+                    else:
+                        errors[value] = error
+            finally:
+                pool.close()
+                pool.join()
+        return results, errors
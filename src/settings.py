@@ -36,9 +36,50 @@ class Config(object):
 
     STATIC_FOLDER = 'static'
 
+    # redis / memcached
+    REDIS_MASTER_SERVER = {
+        'host': environ.get('REDIS_PORT_6379_TCP_ADDR', '127.0.0.1'),
+        'port': int(environ.get('REDIS_PORT_6379_TCP_PORT', 6379)),
+        'db': int(environ.get('REDIS_DB', 0)),
+    }
+    REDIS_SLAVES_SERVER = []
+    MEMCACHED_URLS = environ.get('MEMCACHED_URLS', '127.0.0.1:11211')
+
+    # access token 校验结果缓存时间(秒)，不会超过 token 本身的过期时间
+    TOKEN_INFO_CACHE_TTL = 300
+    # 无效 token 的缓存时间(秒)
+    TOKEN_INFO_NEGATIVE_CACHE_TTL = 60
+
+    # 是否签发自描述的签名 access token(yes/no)，旧的 token 仍然可以使用
+    STATELESS_TOKEN = environ.get('STATELESS_TOKEN', 'no').lower()
+    # 签名 token 的 HMAC 密钥，必须通过环境变量设置，为空时不签发也不接受签名 token
+    TOKEN_SIGNING_KEY = environ.get('TOKEN_SIGNING_KEY', '')
+    # 所有 Bearer token 都有的 scopes(逗号分隔)，接口只需要这些时不校验 token
+    BEARER_IMPLIED_SCOPES = environ.get('BEARER_IMPLIED_SCOPES', 'open')
+
+    # 用户信息缓存时间(秒)
+    ACCOUNT_CACHE_TTL = 60
+    # 每个进程把缓存统计写到 redis 的间隔(秒)，manage.py cache_stats 读取
+    CACHE_STATS_INTERVAL = 60
+
+    # 接口响应的 json 序列化实现: json/simplejson/rapidjson
+    JSON_BACKEND = environ.get('JSON_BACKEND', 'json')
+    # 流式返回列表时每次输出的字节数
+    JSON_STREAM_CHUNK_SIZE = 64 * 1024
+    # 响应压缩: 按顺序协商的编码(br 需要安装 brotli)，小于 COMPRESS_MIN_SIZE
+    # 字节的响应不压缩
+    COMPRESS_ENCODINGS = environ.get('COMPRESS_ENCODINGS', 'br,gzip')
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+
+    # 接口响应缓存的存储: redis/memcache
+    RESPONSE_CACHE_BACKEND = environ.get('RESPONSE_CACHE_BACKEND', 'redis')
+
     # 小程序配置
     WXAPP_APPID = environ.get('WXAPP_APPID', 'wx84cc28b4c3d0d695')
     WXAPP_SECRET = environ.get('WXAPP_SECRET', 'dfbc685afc267d57141c5b7b409865a1')
+    # 小程序码图片缓存目录
+    WXACODE_CACHE_DIR = environ.get('WXACODE_CACHE_DIR', '/data/lt/wxacode')
 
     # 用来app之间走backend接口校验身份，暂时未使用
     APP_CLIENT_ID = 'board'
@@ -2,14 +2,46 @@
 from __future__ import absolute_import
 
 from flask import Blueprint, request, g
+from werkzeug.local import LocalProxy
 import flask_restful as restful
 
+from .api import Resource
 from .routes import routes
-from .validators import security
+from .schemas import security as generated_security
+from .security import security
+from .registries import registry, filter_registry
+from .pipeline import request_validate, response_filter, cache_response
 
 # verify token
-from src.services.verification import verify_token, verify_request
+from zaih_core.verification import get_authorization
+from src.services.verification import (
+    verify_token, verify_request, verify_client)
 from src.models import Account
+from src.settings import Config
+
+
+def load_current_account():
+    # g.account 第一次被访问时才校验 token 并查询用户
+    if not hasattr(g, '_account'):
+        security.scopes
+        g._account = Account.get_cached(getattr(g, 'account_id', None))
+    return g._account
+
+
+@security.cheap_scopes_loader
+def cheap_scopes():
+    # 不查库的 scopes: Basic 只需要和配置比较，Bearer token 都带有
+    # BEARER_IMPLIED_SCOPES，需要其他 scopes 时才完整校验 token
+    g.account = LocalProxy(load_current_account)
+    authorization_type, token = get_authorization()
+    if authorization_type == 'Basic':
+        valid, scopes = verify_client(token)
+        return scopes if valid else []
+    elif authorization_type == 'Bearer' and token:
+        return Config.BEARER_IMPLIED_SCOPES.split(',')
+    elif not authorization_type:
+        return []
+    return None
 
 
 @security.scopes_loader
@@ -25,8 +57,8 @@ def current_scopes():
             scopes = set(token_info)
             return list(scopes)
 
-        account = Account.query.get(token_info.get('account_id'))
-        g.account = account
+        g.account_id = token_info.get('account_id')
+        g.account = LocalProxy(load_current_account)
         return token_info.get('scopes', [])
 
     return []
@@ -48,8 +80,18 @@ def current_scopes():
 
     #return default_scopes
 
+# 生成的 request_validate 用的是 schemas.security，和这里的结果保持一致
+generated_security.scopes_loader(lambda: security.scopes)
+
+# api/__init__.py 是生成的代码，在这里换成 pipeline 中的实现，
+# 列表中靠前的在内层: 缓存命中时跳过 normalize，但仍然先校验参数和 scopes
+Resource.method_decorators = [cache_response, request_validate, response_filter]
+
 bp = Blueprint('v1', __name__, static_folder='static')
 api = restful.Api(bp, catch_all_404s=True)
 
 for route in routes:
     api.add_resource(route.pop('resource'), *route.pop('urls'), **route)
+
+registry.init_blueprint(bp)
+filter_registry.init_blueprint(bp)
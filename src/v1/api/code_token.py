@@ -3,10 +3,11 @@ from __future__ import absolute_import, print_function
 from datetime import timedelta
 from flask import request, g
 from zaih_core.database import db
-from zaih_core.api_errors import Unauthorized
+from zaih_core.api_errors import Unauthorized, InternalServerError
 from zaih_core.ztime import now
 from src.settings import Config
 from src.services.weixin import WXAPPAPI, WXBizDataCrypt
+from src.services.stateless_token import TokenRevokeError
 
 from src.models import WXAuthentication, Account, OAuth2Token
 from . import Resource
@@ -55,17 +56,27 @@ class CodeToken(Resource):
             raise Unauthorized('invalid_wxapp_token:open')
 
         # 5. 生成Account
-        auth = WXAuthentication.query.filter_by(
-            openid=openid,
-            openid_type=WXAuthentication.OPENID_TYPE_XCX,
-        ).first()
+        # 一次查询同时取出授权信息和用户，走 (openid, openid_type) 索引；
+        # 用 outerjoin，用户被删除时仍然能取到授权记录
+        row = (db.session.query(WXAuthentication, Account)
+               .outerjoin(Account, Account.id == WXAuthentication.account_id)
+               .filter(WXAuthentication.openid == openid,
+                       WXAuthentication.openid_type ==
+                       WXAuthentication.OPENID_TYPE_XCX)
+               .first())
+        auth, account = row or (None, None)
 
-        # 第一次登录
-        if not auth:
-            account = Account.create(
+        # 第一次登录，或者授权记录对应的用户已经不存在
+        if account is None:
+            account = Account(
                 nickname=nickname,
                 _avatar=avatar_url,
             )
+            db.session.add(account)
+            # flush 拿到 account.id，和后面的数据在同一个事务里提交
+            db.session.flush()
+        # 已有授权记录时复用，指向新的用户，不再为同一个 openid 新建一条
+        if auth is None:
             wxauth = WXAuthentication(
                 account_id = account.id,
                 unionid = unionid,
@@ -73,15 +84,22 @@ class CodeToken(Resource):
                 openid_type = WXAuthentication.OPENID_TYPE_XCX,
             )
             db.session.add(wxauth)
-        # 再次授权
-        else:
-            account = Account.query.get(auth.account_id)
+        elif auth.account_id != account.id:
+            auth.account_id = account.id
+            if unionid:
+                auth.unionid = unionid
 
+        try:
+            token = OAuth2Token.get_or_create(
+                WXAuthentication.OPENID_TYPE_XCX,
+                account_id=account.id,
+                session_key=session_key,
+                commit=False,
+            )
+        except TokenRevokeError:
+            # 旧 token 没能吊销，不换发新 token，客户端稍后重试
+            db.session.rollback()
+            raise InternalServerError('token_revoke_failed')
         db.session.commit()
-        token = OAuth2Token.get_or_create(
-            WXAuthentication.OPENID_TYPE_XCX,
-            account_id=account.id,
-            session_key=session_key,
-        )
 
         return token, 200, None
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import json
+import zlib
+from datetime import date
+
+from flask import current_app, request
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+_flask_encoder = FlaskJSONEncoder()
+
+
+def default(o):
+    # date 用 isoformat，其他(uuid、__html__ 等)和 flask 的处理一致
+    if isinstance(o, date):
+        return o.isoformat()
+    return _flask_encoder.default(o)
+
+
+class RawJSON(object):
+    """
+    已经序列化好的 json，response_filter 会跳过 normalize 和 dumps 直接返回，
+    etag 不为空时不再计算内容的 sha1，variants 保存压缩后的内容
+
+    return RawJSON(payload), 200, None
+    """
+
+    __slots__ = ('payload', 'etag', 'variants')
+
+    def __init__(self, payload, etag=None, variants=None):
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        self.payload = payload
+        self.etag = etag
+        self.variants = variants or {}
+
+    def encode(self, encoding):
+        """返回压缩后的内容，同一个编码只压缩一次"""
+        body = self.variants.get(encoding)
+        if body is None:
+            body = self.variants[encoding] = COMPRESSORS[encoding](
+                self.payload)
+        return body
+
+    @classmethod
+    def dumps(cls, obj):
+        return cls(dumps(obj))
+
+
+def _json_backend():
+    # 不用 JSONEncoder 子类和 sort_keys，保证走 C 扩展，date 在 default 里处理
+    return json.JSONEncoder(default=default, separators=(',', ':')).encode
+
+
+def _simplejson_backend():
+    import simplejson
+    return simplejson.JSONEncoder(
+        default=default, separators=(',', ':')).encode
+
+
+def _rapidjson_backend():
+    import rapidjson
+
+    def dumps(obj):
+        return rapidjson.dumps(obj, default=default)
+    return dumps
+
+
+BACKENDS = {
+    'json': _json_backend,
+    'simplejson': _simplejson_backend,
+    'rapidjson': _rapidjson_backend,
+}
+
+_encoders = {}
+
+
+def get_encoder(name=None):
+    if name is None:
+        name = current_app.config.get('JSON_BACKEND', 'json')
+    encoder = _encoders.get(name)
+    if encoder is None:
+        # 配置错误和缺少可选模块一样降级为 json，不能让每个响应都 500
+        if name not in BACKENDS:
+            current_app.logger.warning(
+                'unknown json backend %s, use json', name)
+            encoder = _json_backend()
+        else:
+            try:
+                encoder = BACKENDS[name]()
+            except ImportError as e:
+                current_app.logger.warning(
+                    'json backend %s unavailable, use json: %s', name, e)
+                encoder = _json_backend()
+        _encoders[name] = encoder
+    return encoder
+
+
+def dumps(obj):
+    return get_encoder()(obj)
+
+
+def _gzip(payload):
+    c = zlib.compressobj(current_app.config['COMPRESS_LEVEL'],
+                         zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(payload) + c.flush()
+
+
+def gzip_stream(chunks):
+    """流式 gzip，每个分块都 flush，客户端可以边收边解压"""
+    c = zlib.compressobj(current_app.config['COMPRESS_LEVEL'],
+                         zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield c.flush()
+
+
+COMPRESSORS = {
+    'gzip': _gzip,
+}
+
+try:
+    import brotli
+except ImportError:
+    pass
+else:
+    COMPRESSORS['br'] = lambda payload: brotli.compress(payload, quality=5)
+
+
+def compressible(payload):
+    return len(payload) >= current_app.config['COMPRESS_MIN_SIZE']
+
+
+def accept_encoding(streaming=False):
+    """
+    按 Accept-Encoding 和 COMPRESS_ENCODINGS 的顺序选择压缩方式，
+    流式返回只支持 gzip
+    """
+    encodings = [e for e in current_app.config['COMPRESS_ENCODINGS'].split(',')
+                 if e in COMPRESSORS and (not streaming or e == 'gzip')]
+    if not encodings:
+        return None
+    return request.accept_encodings.best_match(encodings)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+schemas.normalize 的编译版本
+
+schemas.py 是生成的代码，重新生成时会被覆盖，所以放在这里
+"""
+from __future__ import absolute_import
+
+import six
+
+
+def compile_normalizer(schema, required_defaults=None):
+    """
+    把 schema 编译成和 normalize 语义一致的函数，schema 只遍历一次
+
+    normalizer = compile_normalizer(schema)
+    result, errors = normalizer(data)
+    """
+    if required_defaults is None:
+        required_defaults = {}
+
+    _MISSING_SKIP, _MISSING_DEFAULT, _MISSING_ERROR = 0, 1, 2
+
+    def _compile_dict(schema):
+        required = schema.get('required', [])
+        props = []
+        for key, _schema in six.iteritems(schema.get('properties', {})):
+            type_ = _schema.get('type', 'object')
+            if type_ in ('object', 'array') or not _schema:
+                normalizer = _compile(_schema)
+                leaf_default = None
+            else:
+                # 叶子节点直接在循环里处理，省掉一次函数调用
+                normalizer = None
+                leaf_default = _schema.get('default')
+            if 'default' in _schema:
+                missing = (_MISSING_DEFAULT, _schema['default'])
+            elif key in required:
+                if type_ in required_defaults:
+                    missing = (_MISSING_DEFAULT, required_defaults[type_])
+                else:
+                    missing = (_MISSING_ERROR, '`%s` is required' % key)
+            else:
+                missing = (_MISSING_SKIP, None)
+            props.append((key, normalizer, leaf_default) + missing)
+        all_of = [_compile(_schema) for _schema in schema.get('allOf', [])]
+        additional = schema.get('additionalProperties', False)
+        if additional:
+            if isinstance(additional, dict):
+                additional = _compile(additional)
+            else:
+                additional = lambda data, errors: data
+
+        def normalize_dict(data, errors):
+            result = {}
+            is_dict = isinstance(data, dict)
+            for key, normalizer, leaf_default, missing, missing_value in props:
+                if is_dict:
+                    has_key = key in data
+                    if has_key:
+                        value = data[key]
+                else:
+                    try:
+                        value = getattr(data, key)
+                        has_key = True
+                    except AttributeError:
+                        has_key = False
+                if has_key:
+                    if normalizer is not None:
+                        result[key] = normalizer(value, errors)
+                    elif value is None:
+                        result[key] = leaf_default
+                    else:
+                        result[key] = value
+                elif missing == _MISSING_DEFAULT:
+                    result[key] = missing_value
+                elif missing == _MISSING_ERROR:
+                    errors.append(dict(name='property_missing',
+                                       message=missing_value))
+
+            for normalizer in all_of:
+                rs_component = normalizer(data, errors)
+                rs_component.update(result)
+                result = rs_component
+
+            if additional:
+                if is_dict:
+                    keys, get = data.keys(), data.get
+                else:
+                    keys = vars(data).keys()
+                    get = lambda key: getattr(data, key, None)
+                for pro in set(keys) - set(result.keys()):
+                    result[pro] = additional(get(pro), errors)
+
+            return result
+
+        return normalize_dict
+
+    def _compile_list(schema):
+        items = _compile(schema.get('items'))
+        has_default = 'default' in schema
+        default = schema.get('default')
+
+        def normalize_list(data, errors):
+            if hasattr(data, '__iter__') and not isinstance(data, dict):
+                return [items(item, errors) for item in data]
+            elif has_default:
+                return default
+            return []
+
+        return normalize_list
+
+    def _compile_default(schema):
+        default = schema.get('default')
+
+        def normalize_default(data, errors):
+            if data is None:
+                return default
+            return data
+
+        return normalize_default
+
+    def _compile(schema):
+        if not schema:
+            return lambda data, errors: None
+        type_ = schema.get('type', 'object')
+        if type_ == 'object':
+            return _compile_dict(schema)
+        if type_ == 'array':
+            return _compile_list(schema)
+        return _compile_default(schema)
+
+    compiled = _compile(schema)
+
+    def normalizer(data):
+        errors = []
+        return compiled(data, errors), errors
+
+    normalizer.schema = schema
+    return normalizer
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+v1 接口的请求处理流程: 参数校验、scopes、响应 normalize、序列化、
+缓存、ETag、压缩和流式输出
+
+validators.py 和 api/__init__.py 是生成的代码，重新生成时会被覆盖，
+这里的实现由 src/v1/__init__.py 设置到 Resource.method_decorators
+"""
+from __future__ import absolute_import
+
+import time
+import hashlib
+from collections import Iterator
+from functools import wraps
+
+import six
+
+from werkzeug.datastructures import MultiDict
+from flask import request, g, current_app, stream_with_context
+from flask_restful import abort
+from flask_restful.utils import unpack
+
+from .schemas import scopes
+from .security import security
+from .registries import registry, filter_registry
+from .encoders import (
+    RawJSON, COMPRESSORS, dumps, compressible, accept_encoding, gzip_stream)
+
+
+def request_validate(view):
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        endpoint = request.endpoint.partition('.')[-1]
+        # scope
+        if (endpoint, request.method) in scopes and not security.satisfies(
+                scopes[(endpoint, request.method)]):
+            abort(403)
+        # data
+        method = request.method
+        if method == 'HEAD':
+            method = 'GET'
+        for location, validator in registry.locations(endpoint, method):
+            value = getattr(request, location, MultiDict())
+            if value is None:
+                value = MultiDict()
+            result, errors = validator.validate(value)
+            if errors:
+                abort(422, message='Unprocessable Entity', errors=errors)
+            setattr(g, location, result)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def render(rv):
+    """
+    按 filters 对 resource 的返回值做 normalize 并序列化，
+    返回 (RawJSON, status, headers)；Response、流式返回和没有定义 filter 的
+    返回值不做处理
+    """
+    if isinstance(rv, current_app.response_class):
+        return rv
+
+    endpoint = request.endpoint.partition('.')[-1]
+    method = request.method
+    if method == 'HEAD':
+        method = 'GET'
+    filter = filter_registry.get(endpoint, method)
+
+    resp = rv
+    headers = None
+    status = None
+    if isinstance(resp, tuple):
+        resp, status, headers = unpack(resp)
+
+    if not filter:
+        if isinstance(resp, RawJSON):
+            return resp, status, headers
+        return rv
+
+    if len(filter) == 1:
+        if six.PY3:
+            status = list(filter.keys())[0]
+        else:
+            status = filter.keys()[0]
+
+    schemas = filter.get(status)
+    if not schemas:
+        # return resp, status, headers
+        abort(500, message='`%d` is not a defined status code.' % status)
+
+    if isinstance(resp, Iterator) and schemas['items']:
+        return stream_response(resp, schemas, status, headers)
+
+    errors = []
+    if not isinstance(resp, RawJSON):
+        resp, errors = schemas['schema'](resp)
+    if schemas['headers']:
+        headers, header_errors = schemas['headers'](headers)
+        errors.extend(header_errors)
+    if errors:
+        abort(500, message='Expectation Failed', errors=errors)
+    if not isinstance(resp, RawJSON):
+        resp = RawJSON(dumps(resp) + '\n')
+
+    return resp, status, headers
+
+
+def response_filter(view):
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        rv = render(view(*args, **kwargs))
+        if isinstance(rv, tuple) and isinstance(rv[0], RawJSON):
+            # 已经序列化过的数据(比如来自缓存)不再 normalize
+            raw, status, headers = rv
+            return conditional_response(raw, status, headers)
+        return rv
+
+    return wrapper
+
+
+def cached(ttl=60, tags=None):
+    """
+    标记 resource 方法的响应可以缓存，由 method_decorators 中的
+    cache_response 实现。只适用于不区分用户的公开接口，
+    缓存按 endpoint、query 参数、url 参数和调用方的 scopes 区分
+
+    class TournamentDetail(Resource):
+
+        @cached(ttl=300, tags=lambda self, id: ['tournament:%s' % id])
+        def get(self, id):
+            ...
+
+    数据修改后调用 response_cache.invalidate('tournament:%s' % id)
+    """
+
+    def decorator(view):
+        view.cache_options = dict(ttl=ttl, tags=tags)
+        return view
+
+    return decorator
+
+
+def cache_response(view):
+    options = getattr(view, 'cache_options', None)
+    if not options:
+        return view
+
+    from src.services.response_cache import response_cache
+
+    # method_decorators 拿到的是 bound method，tags 的第一个参数是 resource
+    resource = getattr(view, '__self__', None)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return view(*args, **kwargs)
+        tags = ()
+        if options['tags']:
+            tags = options['tags'](resource, *args, **kwargs)
+        key = response_cache.key(
+            request.endpoint, sorted(request.args.lists()), kwargs,
+            sorted(set(security.current_scopes())))
+        entry, versions = response_cache.get(key, tags)
+        if entry is not None:
+            payload, etag, headers, variants = entry
+            raw = RawJSON(payload, etag, variants)
+            encoding = negotiate_encoding(raw)
+            if encoding and encoding not in variants:
+                # 第一次有客户端需要这种压缩方式，压缩后存回缓存
+                raw.encode(encoding)
+                response_cache.set(key, versions, raw.payload, raw.etag,
+                                   headers, raw.variants, options['ttl'])
+            return raw, 200, headers
+
+        start = time.time()
+        rv = render(view(*args, **kwargs))
+        response_cache.stats.observe(time.time() - start)
+        if isinstance(rv, tuple) and isinstance(rv[0], RawJSON):
+            raw, status, headers = rv
+            if status in (None, 200):
+                raw.etag = (raw.etag or g.get('etag') or
+                            payload_etag(raw.payload))
+                encoding = negotiate_encoding(raw)
+                if encoding:
+                    raw.encode(encoding)
+                response_cache.set(key, versions, raw.payload, raw.etag,
+                                   headers, raw.variants, options['ttl'])
+        return rv
+
+    return wrapper
+
+
+def conditional(version_func):
+    """
+    由 resource 提供廉价的版本号(比如比赛的更新计数)作为 ETag，
+    If-None-Match 命中时直接返回 304，不再查询、normalize 和序列化
+
+    class Standings(Resource):
+
+        @conditional(lambda self, id: Tournament.get_version(id))
+        def get(self, id):
+            ...
+
+    version_func 返回 None 时按正常流程处理，ETag 由响应内容计算
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            version = version_func(*args, **kwargs)
+            if version is None:
+                return view(*args, **kwargs)
+            etag = version_etag(version)
+            matched = matched_etag(etag)
+            if matched:
+                return not_modified(matched)
+            g.etag = etag
+            return view(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def version_etag(version):
+    # 同一个版本号在不同的 url 和用户下对应不同的内容，
+    # 用 Authorization 区分用户，不需要为此解析 token
+    raw = '%s|%s|%s' % (request.full_path,
+                        request.headers.get('Authorization'), version)
+    return 'v-' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def matched_etag(etag):
+    """If-None-Match 中有 etag 或者它的压缩版本时，返回匹配到的 etag"""
+    if_none_match = request.if_none_match
+    if if_none_match.contains(etag):
+        return etag
+    for encoding in COMPRESSORS:
+        variant = '%s-%s' % (etag, encoding)
+        if if_none_match.contains(variant):
+            return variant
+    return None
+
+
+def not_modified(etag):
+    resp = current_app.response_class(status=304)
+    resp.set_etag(etag)
+    return resp
+
+
+def negotiate_encoding(raw):
+    if not compressible(raw.payload):
+        return None
+    return accept_encoding()
+
+
+def conditional_response(raw, status=None, headers=None):
+    """
+    GET 请求加上 ETag，没有版本号时用响应内容的 sha1，
+    If-None-Match 命中时返回 304。
+
+    响应超过 COMPRESS_MIN_SIZE 时按 Accept-Encoding 压缩，
+    压缩后的 ETag 加上编码后缀，和未压缩的内容区分
+    """
+    resp = json_response(raw.payload, status, headers)
+    encoding = negotiate_encoding(raw)
+    if request.method in ('GET', 'HEAD') and resp.status_code == 200:
+        etag = raw.etag or g.get('etag') or payload_etag(raw.payload)
+        if encoding:
+            etag = '%s-%s' % (etag, encoding)
+        resp.set_etag(etag)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag)
+    if encoding:
+        resp.set_data(raw.encode(encoding))
+        resp.headers['Content-Encoding'] = encoding
+    if compressible(raw.payload):
+        resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def payload_etag(payload):
+    if isinstance(payload, six.text_type):
+        payload = payload.encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()
+
+
+def json_response(payload, status=None, headers=None):
+    return current_app.response_class(
+        payload,
+        status=status,
+        headers=headers,
+        mimetype='application/json'
+    )
+
+
+def stream_response(items, schemas, status=None, headers=None):
+    """
+    resource 返回迭代器时逐条 normalize 并分块输出 json 数组，
+    不在内存中生成完整的列表和字符串
+    """
+    normalizer = schemas['items']
+    errors = []
+    if schemas['headers']:
+        headers, errors = schemas['headers'](headers)
+    # 第一条数据在开始输出前处理，出错时还能返回 500
+    try:
+        first = next(items)
+    except StopIteration:
+        return conditional_response(RawJSON('[]\n'), status, headers)
+    first, item_errors = normalizer(first)
+    errors.extend(item_errors)
+    if errors:
+        abort(500, message='Expectation Failed', errors=errors)
+
+    chunk_size = current_app.config['JSON_STREAM_CHUNK_SIZE']
+
+    def generate():
+        chunk = ['[', dumps(first)]
+        size = len(chunk[1])
+        for item in items:
+            data, item_errors = normalizer(item)
+            if item_errors:
+                # 响应头已经发出，只能中断输出，客户端会收到不完整的 json
+                current_app.logger.error(
+                    'stream response %s aborted: %s',
+                    request.endpoint, item_errors)
+                yield ''.join(chunk)
+                return
+            data = dumps(data)
+            chunk.append(',')
+            chunk.append(data)
+            size += len(data) + 1
+            if size >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                size = 0
+        chunk.append(']\n')
+        yield ''.join(chunk)
+
+    body = generate()
+    encoding = accept_encoding(streaming=True)
+    if encoding:
+        body = gzip_stream(body)
+    resp = json_response(stream_with_context(body), status, headers)
+    resp.vary.add('Accept-Encoding')
+    if encoding:
+        resp.headers['Content-Encoding'] = encoding
+    if g.get('etag'):
+        resp.set_etag('%s-%s' % (g.etag, encoding) if encoding else g.etag)
+    return resp
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+请求参数和响应 schema 的预编译
+
+validators.py 是生成的代码，重新生成时会被覆盖，所以放在这里
+"""
+from __future__ import absolute_import
+
+import six
+
+from werkzeug.datastructures import MultiDict, Headers
+
+from .schemas import validators, filters
+from .validators import FlaskValidatorAdaptor
+from .normalizers import compile_normalizer
+
+
+FALSE_VALUES = frozenset(['n', 'no', 'false', '', '0'])
+
+
+def _first_number(type_):
+    def convert(values):
+        try:
+            return type_(values[0])
+        except ValueError:
+            return values[0]
+    return convert
+
+
+def _all_numbers(type_):
+    def convert(values):
+        try:
+            return list(map(type_, values))
+        except ValueError:
+            # 有非法值时逐个转换，保留原值交给 jsonschema 报错
+            result = []
+            for v in values:
+                try:
+                    result.append(type_(v))
+                except ValueError:
+                    result.append(v)
+            return result
+    return convert
+
+
+class CompiledValidatorAdaptor(FlaskValidatorAdaptor):
+    """
+    生成的 FlaskValidatorAdaptor 每次调用 type_convert 都重新生成转换函数、
+    normalize 时遍历 schema，这里在构造时预先生成
+    """
+
+    def __init__(self, schema):
+        super(CompiledValidatorAdaptor, self).__init__(schema)
+        self.converters = self.build_converters(schema)
+        self.normalizer = compile_normalizer(schema)
+
+    def build_converters(self, schema):
+        # 每个属性的类型转换函数只在构造时生成一次，转换函数接收 MultiDict 的值列表
+        scalar_funs = {
+            'integer': _first_number(int),
+            'boolean': lambda values: values[0].lower() not in FALSE_VALUES,
+            'null': lambda values: None,
+            'number': _first_number(float),
+            'string': lambda values: values[0],
+        }
+        array_funs = {
+            'integer': _all_numbers(int),
+            'boolean': lambda values: [
+                v.lower() not in FALSE_VALUES for v in values],
+            'null': lambda values: [None] * len(values),
+            'number': _all_numbers(float),
+        }
+
+        converters = {}
+        for k, prop in six.iteritems(schema.get('properties', {})):
+            type_ = prop.get('type')
+            if type_ == 'array':
+                item_type = prop.get('items', {}).get('type')
+                # lists() 返回的已经是新的 list，字符串数组直接使用
+                fun = array_funs.get(item_type, lambda values: values)
+            elif type_ in scalar_funs:
+                fun = scalar_funs[type_]
+            else:
+                continue
+            converters[k] = fun
+        return converters
+
+    def type_convert(self, obj):
+        if obj is None:
+            return None
+        if isinstance(obj, (dict, list)) and not isinstance(obj, MultiDict):
+            return obj
+        if isinstance(obj, Headers):
+            obj = MultiDict(six.iteritems(obj))
+        result = dict()
+
+        converters = self.converters
+        for k, values in obj.lists():
+            fun = converters.get(k)
+            result[k] = fun(values) if fun else values[0]
+        return result
+
+    def validate(self, value):
+        value = self.type_convert(value)
+        errors = list(e.message for e in self.validator.iter_errors(value))
+        return self.normalizer(value)[0], errors
+
+
+class ValidatorRegistry(object):
+    """
+    按 (endpoint, method, location) 缓存 CompiledValidatorAdaptor，
+    blueprint 注册时统一编译，请求时只做校验
+
+    registry = ValidatorRegistry(validators)
+    registry.init_blueprint(bp)
+    """
+
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self._adaptors = None
+        self._locations = None
+
+    def compile(self):
+        adaptors = {}
+        locations = {}
+        for (endpoint, method), schemas in six.iteritems(self.schemas):
+            for location, schema in six.iteritems(schemas):
+                adaptor = CompiledValidatorAdaptor(schema)
+                adaptors[(endpoint, method, location)] = adaptor
+                locations.setdefault((endpoint, method), []).append(
+                    (location, adaptor))
+        self._adaptors = adaptors
+        self._locations = locations
+
+    def init_blueprint(self, bp):
+        bp.record_once(lambda state: self.compile())
+
+    def get(self, endpoint, method, location):
+        if self._adaptors is None:
+            self.compile()
+        return self._adaptors.get((endpoint, method, location))
+
+    def locations(self, endpoint, method):
+        if self._locations is None:
+            self.compile()
+        return self._locations.get((endpoint, method), ())
+
+
+class FilterRegistry(object):
+    """
+    把 filters 里的响应 schema 编译成 normalizer，结构和 filters 一致:
+
+    {(endpoint, method): {status: {'schema': normalizer, 'headers': normalizer}}}
+
+    列表类型的 schema 额外编译 'items'，用于流式返回时逐条 normalize
+    """
+
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self._filters = None
+
+    def compile(self):
+        compiled = {}
+        for key, statuses in six.iteritems(self.schemas):
+            compiled[key] = {}
+            for status, schemas in six.iteritems(statuses):
+                headers = None
+                if schemas['headers']:
+                    headers = compile_normalizer(
+                        {'properties': schemas['headers']})
+                items = None
+                schema = schemas['schema'] or {}
+                if schema.get('type') == 'array':
+                    items = compile_normalizer(schema.get('items'))
+                compiled[key][status] = {
+                    'schema': compile_normalizer(schemas['schema']),
+                    'headers': headers,
+                    'items': items,
+                }
+        self._filters = compiled
+
+    def init_blueprint(self, bp):
+        bp.record_once(lambda state: self.compile())
+
+    def get(self, endpoint, method):
+        if self._filters is None:
+            self.compile()
+        return self._filters.get((endpoint, method))
+
+
+registry = ValidatorRegistry(validators)
+filter_registry = FilterRegistry(filters)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+
+from flask import g
+from zaih_core.caching import cache_registry
+
+from .schemas import Security
+
+
+class RequestSecurity(Security):
+    """
+    scopes 在一个请求内只计算一次，保存在 g 上
+
+    cheap_scopes_loader 注册一个不查库的 loader(比如只看 Authorization 类型)，
+    返回 None 表示无法判断。接口要求的 scopes 能被它满足时，
+    不再调用完整的 scopes_loader
+
+    schemas.Security 是生成的代码，扩展放在这个子类中，
+    由 src/v1/__init__.py 注册 loader
+    """
+
+    def __init__(self):
+        super(RequestSecurity, self).__init__()
+        self._cheap_loader = lambda: None
+        self._lock = threading.Lock()
+        self._stats = dict(checks=0, skipped=0, resolved=0)
+
+    @property
+    def scopes(self):
+        if not hasattr(g, '_security_scopes'):
+            self._incr('resolved')
+            g._security_scopes = self._loader()
+        return g._security_scopes
+
+    @property
+    def cheap_scopes(self):
+        if not hasattr(g, '_security_cheap_scopes'):
+            g._security_cheap_scopes = self._cheap_loader()
+        return g._security_cheap_scopes
+
+    def current_scopes(self):
+        """已经完整计算过时用完整的 scopes，否则优先用 cheap_scopes"""
+        if hasattr(g, '_security_scopes'):
+            return g._security_scopes
+        cheap = self.cheap_scopes
+        if cheap is not None:
+            return cheap
+        return self.scopes
+
+    def satisfies(self, required):
+        self._incr('checks')
+        required = set(required)
+        if not hasattr(g, '_security_scopes'):
+            cheap = self.cheap_scopes
+            if cheap is not None and required.issubset(cheap):
+                self._incr('skipped')
+                return True
+        return required.issubset(self.scopes)
+
+    def _incr(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def cheap_scopes_loader(self, func):
+        self._cheap_loader = func
+        return func
+
+
+security = RequestSecurity()
+# 完整校验和跳过的次数，和缓存统计一起由 cache_stats 输出
+cache_registry.register_source('security', security.stats)
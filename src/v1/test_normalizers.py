@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import six
+
+from .schemas import filters, validators, normalize
+from .normalizers import compile_normalizer
+
+
+# filters 之外，覆盖生成的 normalize 支持的其他写法
+SCHEMAS = [
+    {'required': ['id', 'name', 'tags'],
+     'properties': {
+         'id': {'type': 'integer'},
+         'name': {'type': 'string', 'default': 'anonymous'},
+         'tags': {'type': 'array', 'items': {'type': 'string'}},
+         'score': {'type': 'number', 'default': 0},
+     }},
+    {'properties': {
+        'rounds': {'type': 'array', 'items': {
+            'type': 'array', 'default': [], 'items': {
+                'required': ['player_id'],
+                'properties': {
+                    'player_id': {'type': 'integer'},
+                    'won': {'type': 'boolean', 'default': False},
+                }}}},
+    }},
+    {'properties': {'id': {'type': 'integer'}},
+     'additionalProperties': {'properties': {
+         'rank': {'type': 'integer', 'default': 1}}}},
+    {'allOf': [
+        {'properties': {'id': {'type': 'integer'}}, 'required': ['id']},
+        {'properties': {'meta': {'properties': {}}}},
+    ],
+     'properties': {'name': {'type': 'string'}}},
+    {'type': 'array', 'default': [], 'items': {'type': 'integer'}},
+    {'type': 'string', 'default': ''},
+    {},
+]
+
+REQUIRED_DEFAULTS = [None, {'integer': 0, 'string': '', 'array': []}]
+
+
+class Obj(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def sample(schema):
+    type_ = schema.get('type', 'object')
+    if type_ == 'object':
+        data = dict((key, sample(_schema)) for key, _schema
+                    in six.iteritems(schema.get('properties', {})))
+        for _schema in schema.get('allOf', []):
+            data.update(sample(_schema))
+        data['extra'] = {'rank': None}
+        return data
+    if type_ == 'array':
+        return [sample(schema.get('items') or {}), None]
+    return {'integer': 1, 'number': 1.5, 'boolean': False,
+            'string': 's'}.get(type_, 'v')
+
+
+def variants(schema):
+    """完整的数据、缺少或者为 None 的字段、类型不对的数据和对象"""
+    full = sample(schema)
+    yield full
+    for value in (None, 'x', [], {}, [{}]):
+        yield value
+    if isinstance(full, dict):
+        for key in full:
+            yield dict((k, v) for k, v in six.iteritems(full) if k != key)
+            yield dict(full, **{key: None})
+            yield dict(full, **{key: 'x'})
+        yield Obj(**full)
+
+
+def all_schemas():
+    for statuses in filters.values():
+        for schemas in statuses.values():
+            yield schemas['schema']
+            if schemas['headers']:
+                yield {'properties': schemas['headers']}
+    for locations in validators.values():
+        for schema in locations.values():
+            yield schema
+    for schema in SCHEMAS:
+        yield schema
+
+
+def outcome(func, *args):
+    # 出错时也要一致，比如 additionalProperties 遇到非 dict 的数据
+    try:
+        return func(*args)
+    except Exception as e:
+        return type(e)
+
+
+def test_compile_normalizer_parity():
+    checked = 0
+    for schema in all_schemas():
+        for required_defaults in REQUIRED_DEFAULTS:
+            normalizer = compile_normalizer(schema, required_defaults)
+            for data in variants(schema):
+                assert (outcome(normalizer, data) ==
+                        outcome(normalize, schema, data, required_defaults)), (
+                    schema, data)
+                checked += 1
+    assert checked > 100
+
+
+def test_compile_normalizer_additional_true():
+    # 生成的 normalize 不支持 additionalProperties: true(会抛出
+    # AttributeError)，编译版本原样保留多余的字段
+    normalizer = compile_normalizer({
+        'properties': {'id': {'type': 'integer'}},
+        'additionalProperties': True})
+    assert normalizer({'id': 1, 'extra': [1]}) == ({'id': 1, 'extra': [1]}, [])